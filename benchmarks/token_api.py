@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+"""Throughput and latency benchmark of the token API.
+
+Drives /validate, /transform and /create through the Flask test client and
+the TokenAuthority methods directly, for several purse sizes and numbers of
+concurrent workers, and writes the results as JSON, e.g.:
+
+    benchmarks/token_api.py --database-url postgresql://localhost/upay_bench \
+        --purse-sizes 1,10,50 --concurrency 1,4,16 --output results.json
+
+The database is bootstrapped, so never point this at production data.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+from decimal import Decimal
+from timeit import default_timer as clock
+
+from sqlalchemy import event
+
+from upay.common import Token
+
+from upay.server import create_app
+from upay.server.utils import get_token_authority
+
+
+class StatementCounter(object):
+    def __init__(self, engine):
+        self.count = 0
+        self._lock = threading.Lock()
+        event.listen(engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args):
+        with self._lock:
+            self.count += 1
+
+
+def _percentile(values, percentile):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * percentile / 100.0))]
+
+
+def _token_json(token):
+    return json.loads(str(token))
+
+
+def _mint_purse(authority, purse_size):
+    tokens = [Token(Decimal(1)) for x in xrange(purse_size)]
+    with authority.session() as token_authority:
+        token_authority.connect()
+        token_authority.mint_tokens(tokens)
+        token_authority.commit()
+    return tokens
+
+
+class Worker(object):
+    """Runs one scenario repeatedly with its own purse of tokens."""
+
+    def __init__(self, app, authority, scenario, purse_size):
+        self._authority = authority
+        self._scenario = scenario
+        self._purse_size = purse_size
+        self._purse = _mint_purse(authority, purse_size)
+        self._client = app.test_client()
+        self.latencies = []
+        self.failures = 0
+
+    def _post(self, path, data):
+        response = self._client.post(path, data=json.dumps(data),
+                                     content_type='application/json',
+                                     headers={'Authorization': 'Bearer benchmark'})
+        return response.status_code == 200
+
+    def api_validate(self):
+        return self._post('/api/v1.0/validate', {'tokens': map(_token_json, self._purse)})
+
+    def api_transform(self):
+        outputs = [Token(Decimal(1)) for x in xrange(self._purse_size)]
+        ok = self._post('/api/v1.0/transform', {'input_tokens': map(_token_json, self._purse),
+                                                'output_tokens': map(_token_json, outputs)})
+        if ok:
+            self._purse = outputs
+        return ok
+
+    def api_create(self):
+        return self._post('/api/v1.0/create', {'values': ['001.00'] * self._purse_size})
+
+    def authority_validate(self):
+        with self._authority.session() as token_authority:
+            token_authority.connect()
+            valid_tokens = token_authority.validate_tokens(self._purse)
+            token_authority.commit()
+        return len(valid_tokens) == len(self._purse)
+
+    def authority_transform(self):
+        outputs = [Token(Decimal(1)) for x in xrange(self._purse_size)]
+        with self._authority.session() as token_authority:
+            token_authority.connect()
+            token_authority.transform_tokens(self._purse, outputs)
+            token_authority.commit()
+        self._purse = outputs
+        return True
+
+    def run(self, requests):
+        scenario = getattr(self, self._scenario)
+        for x in xrange(requests):
+            start = clock()
+            try:
+                ok = scenario()
+            except Exception:
+                ok = False
+            self.latencies.append(clock() - start)
+            if not ok:
+                self.failures += 1
+
+
+def run_benchmark(app, authority, scenario, purse_size, concurrency, requests, counter):
+    workers = [Worker(app, authority, scenario, purse_size) for x in xrange(concurrency)]
+    threads = [threading.Thread(target=worker.run, args=(requests,)) for worker in workers]
+
+    statements = counter.count
+    start = clock()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = clock() - start
+    statements = counter.count - statements
+
+    latencies = sum([worker.latencies for worker in workers], [])
+    return {
+        'scenario': scenario,
+        'purse_size': purse_size,
+        'concurrency': concurrency,
+        'requests': len(latencies),
+        'failures': sum(worker.failures for worker in workers),
+        'requests_per_second': len(latencies) / duration,
+        'p50_seconds': _percentile(latencies, 50),
+        'p99_seconds': _percentile(latencies, 99),
+        'statements_per_request': float(statements) / len(latencies),
+    }
+
+
+def _int_list(value):
+    return [int(x) for x in value.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the token API.')
+    parser.add_argument('--database-url',
+                        help='database to run against (default: a temporary SQLite file)')
+    parser.add_argument('--scenarios', default='api_validate,api_transform,api_create,'
+                                               'authority_validate,authority_transform')
+    parser.add_argument('--purse-sizes', type=_int_list, default=[1, 10, 50])
+    parser.add_argument('--concurrency', type=_int_list, default=[1, 4])
+    parser.add_argument('--requests', type=int, default=100,
+                        help='requests per worker and benchmark (default: 100)')
+    parser.add_argument('--lock-mode', choices=['global', 'token'], default='global')
+    parser.add_argument('--output', help='write the results to this file instead of stdout')
+    args = parser.parse_args()
+
+    database_url = args.database_url
+    if database_url is None:
+        database_url = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'benchmark.db')
+
+    app = create_app({
+        'DATABASE_URL': database_url,
+        'DATABASE_ALLOW_BOOTSTRAP': True,
+        'LOCK_MODE': args.lock_mode,
+        'CREATE_API_KEYS': ['benchmark'],
+        'CREATE_MAX_TOKENS': max(args.purse_sizes),
+    })
+    with app.app_context():
+        authority = get_token_authority()
+    authority.bootstrap_db()
+    counter = StatementCounter(authority._engine)
+
+    results = []
+    for scenario in args.scenarios.split(','):
+        for purse_size in args.purse_sizes:
+            for concurrency in args.concurrency:
+                result = run_benchmark(app, authority, scenario, purse_size, concurrency,
+                                       args.requests, counter)
+                sys.stderr.write('%(scenario)s purse=%(purse_size)d concurrency=%(concurrency)d: '
+                                 '%(requests_per_second).1f req/s, p99 %(p99_seconds).4fs\n' % result)
+                results.append(result)
+
+    report = {
+        'database_url': database_url.split('@')[-1],
+        'lock_mode': args.lock_mode,
+        'time': time.time(),
+        'results': results,
+    }
+    output = open(args.output, 'w') if args.output else sys.stdout
+    json.dump(report, output, indent=2, sort_keys=True)
+    output.write('\n')
+
+if __name__ == '__main__':
+    main()
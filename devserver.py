@@ -3,10 +3,10 @@
 import os
 import os.path
 
-from upay.server import app
-from upay.server.token_authority import TokenAuthority
+from upay.server import create_app
+from upay.server.config import load_config
 
-app.config.from_pyfile(os.path.join(os.getcwd(), 'devserver.cfg'))
+app = create_app(load_config(os.path.join(os.getcwd(), 'devserver.cfg')))
 
 if 'USE_SSL' in app.config and app.config['USE_SSL']:
     from OpenSSL import SSL
@@ -14,6 +14,4 @@ if 'USE_SSL' in app.config and app.config['USE_SSL']:
     context.use_privatekey_file('test.key')
     context.use_certificate_file('test.crt')
 
-authority = TokenAuthority(app.config)
-
 app.run()
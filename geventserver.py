@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# Serves the API from a single process with gevent. Every request runs in a
+# greenlet, and with psycogreen installed, PostgreSQL queries yield to
+# other requests instead of blocking the process.
+#
+# Install the dependencies with `pip install upay-server[gevent]`.
+
+from gevent import monkey
+monkey.patch_all()
+
+import os
+import logging
+
+try:
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+except ImportError:
+    logging.getLogger(__name__).warning(
+        "psycogreen is not installed, database queries block the server")
+
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+
+from upay.server import create_app
+from upay.server.config import load_config
+
+if 'UPAY_SERVER_CONFIG' in os.environ:
+    app = create_app()
+else:
+    app = create_app(load_config(os.path.join(os.getcwd(), 'devserver.cfg')))
+
+host = app.config.get('SERVER_HOST', '127.0.0.1')
+port = app.config.get('SERVER_PORT', 5000)
+pool = Pool(app.config.get('GEVENT_MAX_REQUESTS', 10000))
+
+WSGIServer((host, port), app, spawn=pool).serve_forever()
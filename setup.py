@@ -24,13 +24,18 @@ setup(
     ],
     install_requires=['Flask', 'sqlalchemy', 'jsonschema', 'iso8601', 'psycopg2'],
     extras_require={
-        'tests': ['mock']
+        'tests': ['mock'],
+        'gevent': ['gevent', 'psycogreen'],
+        'ujson': ['ujson'],
+        'msgpack': ['msgpack>=0.5.2'],
     },
     entry_points=dict(
         console_scripts=[
-            'token-authority-server = upay.server:app.run',
+            'token-authority-server = upay.server:run',
             'token-authority-bootstrap-db = upay.server.cli:bootstrap_db',
             'token-authority-create-tokens = upay.server.cli:create_tokens',
+            'token-authority-migrate-db = upay.server.cli:migrate_db',
+            'token-authority-compact = upay.server.cli:compact',
         ],
     ),
     keywords='upay',
@@ -0,0 +1,60 @@
+import unittest
+import threading
+from mock import patch
+
+import upay.server.admission
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    @patch('upay.server.admission.clock')
+    def test_burst_and_rate(self, clock_mock):
+        clock_mock.return_value = 100
+        limiter = upay.server.admission.RateLimiter(rate=2, burst=3)
+        self.assertEquals([limiter.acquire('a') for i in range(3)], [0, 0, 0])
+        self.assertAlmostEquals(limiter.acquire('a'), 0.5)
+
+        # Other clients have buckets of their own
+        self.assertEquals(limiter.acquire('b'), 0)
+
+        clock_mock.return_value = 100.5
+        self.assertEquals(limiter.acquire('a'), 0)
+        self.assertTrue(limiter.acquire('a') > 0)
+
+    def test_max_clients(self):
+        limiter = upay.server.admission.RateLimiter(rate=1, max_clients=2)
+        map(limiter.acquire, 'abc')
+        self.assertEquals(len(limiter), 2)
+
+
+class AdmissionQueueTest(unittest.TestCase):
+
+    def test_max_active(self):
+        queue = upay.server.admission.AdmissionQueue(2, max_waiting=0)
+        self.assertTrue(queue.acquire())
+        self.assertTrue(queue.acquire())
+        self.assertFalse(queue.acquire())
+        queue.release()
+        self.assertTrue(queue.acquire())
+
+    def test_timeout(self):
+        queue = upay.server.admission.AdmissionQueue(1, max_waiting=1, timeout=0.01)
+        self.assertTrue(queue.acquire())
+        self.assertFalse(queue.acquire())
+        self.assertEquals(queue.waiting, 0)
+
+    def test_wait(self):
+        queue = upay.server.admission.AdmissionQueue(1, max_waiting=1, timeout=10)
+        self.assertTrue(queue.acquire())
+        results = []
+        thread = threading.Thread(target=lambda: results.append(queue.acquire()))
+        thread.start()
+        while queue.waiting == 0:
+            pass
+        queue.release()
+        thread.join()
+        self.assertEquals(results, [True])
+        self.assertEquals(queue.active, 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,198 @@
+import unittest
+import json
+import logging
+import os
+import shutil
+import tempfile
+from decimal import Decimal
+
+import upay.common
+from upay.server import create_app, metrics
+from upay.server.utils import get_token_authority
+
+
+class ApiTest(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig(level=logging.ERROR)
+        self._app = create_app({
+            'DATABASE_URL': 'sqlite:///:memory:',
+            'DATABASE_ALLOW_BOOTSTRAP': True,
+            'TESTING': True,
+        })
+        self._client = self._app.test_client()
+        with self._app.app_context():
+            get_token_authority().bootstrap_db()
+
+    def _store(self, tokens):
+        with self._app.app_context():
+            with get_token_authority().session() as session:
+                session.connect()
+                session.mint_tokens(tokens)
+                session.commit()
+
+
+class ValidateStreamTest(ApiTest):
+
+    def test_validate_stream(self):
+        valid_token = upay.common.Token(Decimal(1))
+        unknown_token = upay.common.Token(Decimal(1))
+        self._store([valid_token])
+        requests = metrics.requests.value('validate_stream', 200)
+
+        body = '%s\n%s\n\nno token\n' % (valid_token, unknown_token)
+        response = self._client.post('/api/v1.0/validate/stream', data=body,
+                                     content_type='application/x-ndjson', buffered=True)
+
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.mimetype, 'application/x-ndjson')
+        lines = map(json.loads, response.get_data().splitlines())
+        self.assertEquals([line.get('valid') for line in lines], [True, False, None])
+        self.assertEquals(json.loads(lines[0]['token']), json.loads(str(valid_token)))
+        self.assertEquals(lines[2]['line'], 4)
+        self.assertIn('validation-error', lines[2])
+
+        # Recorded once the streamed response was closed
+        self.assertEquals(metrics.requests.value('validate_stream', 200), requests + 1)
+
+
+class TransformTest(ApiTest):
+
+    def _transform(self, input_tokens, output_tokens, key, client=None):
+        body = {'input_tokens': [json.loads(str(t)) for t in input_tokens],
+                'output_tokens': [json.loads(str(t)) for t in output_tokens]}
+        return (client or self._client).post('/api/v1.0/transform', data=json.dumps(body),
+                                             content_type='application/json',
+                                             headers={'Idempotency-Key': key})
+
+    def test_replay(self):
+        token = upay.common.Token(Decimal(2))
+        self._store([token])
+        output_tokens = [upay.common.Token(Decimal(1)), upay.common.Token(Decimal(1))]
+
+        response = self._transform([token], output_tokens, 'key')
+        self.assertEquals(response.status_code, 200)
+        self.assertNotIn('Idempotent-Replayed', response.headers)
+
+        replay = self._transform([token], output_tokens, 'key')
+        self.assertEquals(replay.status_code, 200)
+        self.assertEquals(replay.headers['Idempotent-Replayed'], 'true')
+        self.assertEquals(json.loads(replay.get_data()), json.loads(response.get_data()))
+
+    def test_key_reused(self):
+        token = upay.common.Token(Decimal(2))
+        self._store([token])
+
+        response = self._transform([token], [upay.common.Token(Decimal(2))], 'key')
+        self.assertEquals(response.status_code, 200)
+
+        response = self._transform([token], [upay.common.Token(Decimal(2))], 'key')
+        self.assertEquals(response.status_code, 422)
+        self.assertIn('idempotency-error', json.loads(response.get_data()))
+
+    def test_replay_by_other_process(self):
+        directory = tempfile.mkdtemp()
+        try:
+            config = {
+                'DATABASE_URL': 'sqlite:///' + os.path.join(directory, 'tokens.db'),
+                'DATABASE_ALLOW_BOOTSTRAP': True,
+                'TESTING': True,
+            }
+            self._app = create_app(config)
+            with self._app.app_context():
+                get_token_authority().bootstrap_db()
+            token = upay.common.Token(Decimal(2))
+            self._store([token])
+            output_tokens = [upay.common.Token(Decimal(2))]
+
+            response = self._transform([token], output_tokens, 'key', self._app.test_client())
+            self.assertEquals(response.status_code, 200)
+
+            # A second app has its own memory, like another worker
+            other = create_app(config).test_client()
+            replay = self._transform([token], output_tokens, 'key', other)
+            self.assertEquals(replay.status_code, 200)
+            self.assertEquals(replay.headers['Idempotent-Replayed'], 'true')
+        finally:
+            shutil.rmtree(directory)
+
+
+class AdmissionTest(ApiTest):
+
+    def _validate(self, token, headers=None):
+        return self._client.post('/api/v1.0/validate',
+                                 data=json.dumps({'tokens': [json.loads(str(token))]}),
+                                 content_type='application/json', headers=headers or {})
+
+    def test_rate_limited(self):
+        self._app.config.update(RATE_LIMIT=0.5, RATE_LIMIT_BURST=1,
+                                RATE_LIMIT_HEADER='X-Terminal')
+        token = upay.common.Token(Decimal(1))
+
+        self.assertEquals(self._validate(token, {'X-Terminal': 'a'}).status_code, 200)
+        response = self._validate(token, {'X-Terminal': 'a'})
+        self.assertEquals(response.status_code, 429)
+        self.assertEquals(response.headers['Retry-After'], '2')
+        self.assertEquals(self._validate(token, {'X-Terminal': 'b'}).status_code, 200)
+
+    def test_overloaded(self):
+        self._app.config.update(ADMISSION_MAX_ACTIVE=1, ADMISSION_MAX_WAITING=0,
+                                ADMISSION_TIMEOUT=2)
+        token = upay.common.Token(Decimal(1))
+
+        # A streamed response holds its slot until it is closed
+        stream = self._client.post('/api/v1.0/validate/stream', data='%s\n' % token,
+                                   content_type='application/x-ndjson')
+        response = self._validate(token)
+        self.assertEquals(response.status_code, 503)
+        self.assertEquals(response.headers['Retry-After'], '2')
+
+        stream.get_data()
+        stream.close()
+        self.assertEquals(self._validate(token).status_code, 200)
+
+
+class CreateTest(ApiTest):
+
+    def _create(self, values, key=None):
+        headers = {'Authorization': 'Bearer %s' % key} if key is not None else {}
+        return self._client.post('/api/v1.0/create', data=json.dumps({'values': values}),
+                                 content_type='application/json', headers=headers)
+
+    def test_create_disabled(self):
+        response = self._create(['001.00'], 'secret')
+
+        self.assertEquals(response.status_code, 403)
+
+    def test_create_unauthorized(self):
+        self._app.config['CREATE_API_KEYS'] = ['secret']
+
+        self.assertEquals(self._create(['001.00']).status_code, 401)
+        self.assertEquals(self._create(['001.00'], 'wrong').status_code, 401)
+
+    def test_create_too_many(self):
+        self._app.config['CREATE_API_KEYS'] = ['secret']
+        self._app.config['CREATE_MAX_TOKENS'] = 2
+
+        response = self._create(['001.00'] * 3, 'secret')
+
+        self.assertEquals(response.status_code, 400)
+
+    def test_create(self):
+        self._app.config['CREATE_API_KEYS'] = ['secret']
+
+        response = self._create(['001.00', '002.50'], 'secret')
+
+        self.assertEquals(response.status_code, 200)
+        created_tokens = map(json.loads, json.loads(response.get_data())['created_tokens'])
+        self.assertEquals(len(created_tokens), 2)
+
+        response = self._client.post('/api/v1.0/validate',
+                                     data=json.dumps({'tokens': created_tokens}),
+                                     content_type='application/json')
+        self.assertEquals(response.status_code, 200)
+        valid_tokens = json.loads(response.get_data())['valid_tokens']
+        self.assertEquals(sorted(map(json.loads, valid_tokens)), sorted(created_tokens))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+import hashlib
+from datetime import datetime, timedelta
+
+import upay.server.bloom
+
+
+def hash_string(i):
+    return hashlib.sha512(str(i)).hexdigest()
+
+
+class FakeToken(object):
+    def __init__(self, i, created):
+        self.hash_string = hash_string(i)
+        self.created = created
+
+
+class BloomFilterTest(unittest.TestCase):
+
+    def test_contains(self):
+        bloom = upay.server.bloom.BloomFilter(1000, 0.01)
+        map(bloom.add, map(hash_string, range(1000)))
+
+        for i in range(1000):
+            self.assertIn(hash_string(i), bloom)
+        self.assertEquals(bloom.count, 1000)
+
+    def test_error_rate(self):
+        bloom = upay.server.bloom.BloomFilter(1000, 0.01)
+        map(bloom.add, map(hash_string, range(1000)))
+
+        false_positives = len([i for i in range(1000, 11000) if hash_string(i) in bloom])
+        self.assertLess(false_positives, 200)
+
+
+class TokenFilterTest(unittest.TestCase):
+
+    def test_might_be_valid(self):
+        built = datetime.utcnow()
+        token_filter = upay.server.bloom.TokenFilter(100, 0.001, built)
+        token_filter.add(hash_string(1))
+
+        self.assertTrue(token_filter.might_be_valid(FakeToken(1, built)))
+        self.assertFalse(token_filter.might_be_valid(FakeToken(2, built)))
+        self.assertTrue(token_filter.might_be_valid(FakeToken(3, built + timedelta(seconds=1))))
+        self.assertEquals(token_filter.stats()['checks'], 3)
+        self.assertEquals(token_filter.stats()['rejected'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,34 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+import upay.server.cli
+
+
+class ResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        self._path = os.path.join(self._directory, 'tokens')
+
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+
+    def test_missing_file(self):
+        self.assertEquals(upay.server.cli._count_complete_lines(self._path), 0)
+
+    def test_complete_lines(self):
+        with open(self._path, 'w') as f:
+            f.write('{"a": 1}\n{"b": 2}\n')
+        self.assertEquals(upay.server.cli._count_complete_lines(self._path), 2)
+        self.assertEquals(open(self._path).read(), '{"a": 1}\n{"b": 2}\n')
+
+    def test_partial_line(self):
+        with open(self._path, 'w') as f:
+            f.write('{"a": 1}\n{"b"')
+        self.assertEquals(upay.server.cli._count_complete_lines(self._path), 1)
+        self.assertEquals(open(self._path).read(), '{"a": 1}\n')
+
+if __name__ == '__main__':
+    unittest.main()
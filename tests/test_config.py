@@ -0,0 +1,31 @@
+import os
+import unittest
+import tempfile
+
+import upay.server.config
+
+
+class LoadConfigTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self._path = tempfile.mkstemp(suffix='.cfg')
+        with os.fdopen(fd, 'w') as f:
+            f.write("DATABASE_URL = 'sqlite:///:memory:'\nlowercase = 1\n")
+
+    def tearDown(self):
+        os.remove(self._path)
+
+    def test_load_config(self):
+        config = upay.server.config.load_config(self._path)
+        self.assertEquals(config, {'DATABASE_URL': 'sqlite:///:memory:'})
+
+    def test_load_config_from_environment(self):
+        os.environ['UPAY_SERVER_CONFIG'] = self._path
+        try:
+            self.assertEquals(upay.server.config.load_config()['DATABASE_URL'], 'sqlite:///:memory:')
+        finally:
+            del os.environ['UPAY_SERVER_CONFIG']
+        self.assertEquals(upay.server.config.load_config(), {})
+
+if __name__ == '__main__':
+    unittest.main()
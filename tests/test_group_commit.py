@@ -0,0 +1,77 @@
+import unittest
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from decimal import Decimal
+
+import upay.common
+import upay.server.group_commit
+import upay.server.token_authority
+
+
+class GroupCommitterTest(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig(level=logging.CRITICAL)
+        self._directory = tempfile.mkdtemp()
+        # The committer runs in a thread of its own, which would get an
+        # empty in-memory database
+        self.config = {
+            'DATABASE_URL': 'sqlite:///' + os.path.join(self._directory, 'tokens.db'),
+            'DATABASE_ALLOW_BOOTSTRAP': True,
+            'GROUP_COMMIT_MAX_DELAY': 0.2,
+        }
+        self._ta = upay.server.token_authority.TokenAuthority(self.config)
+        self._ta.bootstrap_db()
+        self._committer = upay.server.group_commit.GroupCommitter(self._ta, self.config)
+
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+
+    def _validate(self, tokens):
+        with self._ta.session() as session:
+            session.connect()
+            return session.validate_tokens(tokens)
+
+    def _submit_concurrently(self, works):
+        results = [None] * len(works)
+
+        def submit(i):
+            try:
+                results[i] = self._committer.submit(works[i], 'test')
+            except Exception as ex:
+                results[i] = ex
+
+        threads = [threading.Thread(target=submit, args=(i,)) for i in range(len(works))]
+        map(threading.Thread.start, threads)
+        map(threading.Thread.join, threads)
+        return results
+
+    def test_submit(self):
+        tokens = map(upay.common.Token, map(Decimal, (1, 2, 3)))
+        self._committer.submit(lambda ta: ta.mint_tokens(tokens), 'test')
+        self.assertEquals(self._validate(tokens), tokens)
+
+    def test_group(self):
+        purses = [[upay.common.Token(Decimal(i))] for i in range(1, 6)]
+        self._submit_concurrently([lambda ta, purse=purse: ta.mint_tokens(purse)
+                                       for purse in purses])
+        tokens = sum(purses, [])
+        self.assertEquals(self._validate(tokens), tokens)
+
+    def test_failing_request(self):
+        tokens = [upay.common.Token(Decimal(1))]
+        unknown_token = upay.common.Token(Decimal(1))
+        results = self._submit_concurrently([
+            lambda ta: ta.mint_tokens(tokens),
+            lambda ta: ta.transform_tokens([unknown_token], [upay.common.Token(Decimal(1))])])
+
+        self.assertIn(None, results)
+        self.assertEquals(len([r for r in results if
+            isinstance(r, upay.server.token_authority.NoValidTokenFoundError)]), 1)
+        self.assertEquals(self._validate(tokens), tokens)
+
+if __name__ == '__main__':
+    unittest.main()
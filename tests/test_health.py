@@ -0,0 +1,70 @@
+import unittest
+import logging
+import threading
+import time
+from mock import patch
+
+import upay.server.health
+
+
+class HealthMonitorTest(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig(level=logging.CRITICAL)
+        self.probes = 0
+        self.fail = False
+
+    def probe(self):
+        self.probes += 1
+        if self.fail:
+            raise RuntimeError("database down")
+
+    def test_not_yet_checked(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def probe():
+            started.set()
+            release.wait()
+
+        monitor = upay.server.health.HealthMonitor(probe, interval=3600)
+        monitor.start()
+        try:
+            self.assertTrue(started.wait(5))
+            self.assertEquals(monitor.status(), (False, None))
+        finally:
+            release.set()
+
+    def test_start(self):
+        monitor = upay.server.health.HealthMonitor(self.probe, interval=3600)
+        monitor.start()
+        monitor.start()
+        deadline = time.time() + 5
+        while monitor.status()[1] is None and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(monitor.status()[0])
+        self.assertEquals(self.probes, 1)
+
+    def test_failed_probe(self):
+        monitor = upay.server.health.HealthMonitor(self.probe, interval=3600)
+        self.assertTrue(monitor.check())
+        self.fail = True
+        self.assertFalse(monitor.check())
+        self.assertFalse(monitor.status()[0])
+        self.fail = False
+        self.assertTrue(monitor.check())
+        self.assertTrue(monitor.status()[0])
+
+    @patch('time.time')
+    def test_stale_result(self, time_mock):
+        time_mock.return_value = 1000
+        monitor = upay.server.health.HealthMonitor(self.probe, interval=3600, max_age=10)
+        monitor.check()
+        self.assertTrue(monitor.status()[0])
+        time_mock.return_value = 1011
+        healthy, age = monitor.status()
+        self.assertFalse(healthy)
+        self.assertEquals(age, 11)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+import unittest
+import logging
+import os
+import select
+import threading
+import Queue
+
+import upay.server.log
+
+
+def record(level):
+    return logging.LogRecord('test', level, __file__, 1, "Token %s", ('t',), None)
+
+
+class CollectingHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(self.format(record))
+
+
+class WaitingHandler(logging.Handler):
+    """Blocks in emit() until released."""
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.entered = threading.Event()
+        self.released = threading.Event()
+
+    def emit(self, record):
+        self.entered.set()
+        self.released.wait()
+
+
+class PipeHandler(logging.Handler):
+    def __init__(self, fd):
+        logging.Handler.__init__(self)
+        self.fd = fd
+        self.written = threading.Event()
+
+    def emit(self, record):
+        os.write(self.fd, self.format(record) + '\n')
+        self.written.set()
+
+
+class SamplingFilterTest(unittest.TestCase):
+
+    def test_sampling(self):
+        sample = upay.server.log.SamplingFilter(0.1)
+        passed = len([r for r in (record(logging.DEBUG) for i in range(10000)) if sample.filter(r)])
+        self.assertTrue(500 < passed < 1500)
+
+    def test_warnings_pass(self):
+        sample = upay.server.log.SamplingFilter(0)
+        self.assertFalse(sample.filter(record(logging.DEBUG)))
+        self.assertTrue(sample.filter(record(logging.INFO)))
+        self.assertTrue(sample.filter(record(logging.WARNING)))
+
+
+class QueueHandlerTest(unittest.TestCase):
+
+    def test_listener(self):
+        queue = Queue.Queue()
+        target = CollectingHandler()
+        target.setLevel(logging.INFO)
+        queue.put(record(logging.DEBUG))
+        queue.put(record(logging.WARNING))
+
+        listener = upay.server.log.QueueListener(queue, target)
+        while not queue.empty():
+            listener.handle(queue.get())
+        self.assertEquals(target.messages, ['Token t'])
+
+    def test_full_queue(self):
+        target = WaitingHandler()
+        handler = upay.server.log.QueueHandler(1, target)
+        dropped = upay.server.log.dropped_records.value()
+        try:
+            handler.handle(record(logging.INFO))
+            # The listener holds the first record, the second fills the queue
+            self.assertTrue(target.entered.wait(5))
+            handler.handle(record(logging.INFO))
+            handler.handle(record(logging.INFO))
+            self.assertEquals(upay.server.log.dropped_records.value(), dropped + 1)
+        finally:
+            target.released.set()
+
+    def test_fork(self):
+        read_fd, write_fd = os.pipe()
+        target = PipeHandler(write_fd)
+        handler = upay.server.log.QueueHandler(10, target)
+        handler.handle(logging.LogRecord('test', logging.INFO, __file__, 1, "parent", (), None))
+        self.assertTrue(target.written.wait(5))
+
+        pid = os.fork()
+        if pid == 0:
+            try:
+                target.written = threading.Event()
+                handler.handle(logging.LogRecord('test', logging.INFO, __file__, 1, "child", (), None))
+                target.written.wait(5)
+            finally:
+                os._exit(0)
+
+        output = ''
+        try:
+            while 'child\n' not in output and select.select([read_fd], [], [], 5)[0]:
+                output += os.read(read_fd, 1024)
+        finally:
+            os.waitpid(pid, 0)
+            os.close(read_fd)
+            os.close(write_fd)
+        self.assertEquals(output, 'parent\nchild\n')
+
+    def test_queue_handlers(self):
+        target = CollectingHandler()
+        logger = logging.getLogger('upay.test_log')
+        logger.addHandler(target)
+        try:
+            upay.server.log.queue_handlers([logger], 10)
+            upay.server.log.queue_handlers([logger], 10)
+            self.assertEquals(len(logger.handlers), 1)
+            self.assertIsInstance(logger.handlers[0], upay.server.log.QueueHandler)
+        finally:
+            logger.handlers = []
+
+if __name__ == '__main__':
+    unittest.main()
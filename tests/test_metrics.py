@@ -0,0 +1,46 @@
+import unittest
+
+import upay.server.metrics
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self._registry = upay.server.metrics.Registry()
+
+    def test_counter(self):
+        counter = self._registry.counter('requests_total', 'Requests', ['endpoint'])
+        counter.inc('validate')
+        counter.inc('validate', amount=2)
+
+        self.assertEquals(counter.value('validate'), 3)
+        self.assertIn('requests_total{endpoint="validate"} 3.0', self._registry.render())
+
+    def test_histogram(self):
+        histogram = self._registry.histogram('duration_seconds', 'Duration', buckets=(0.1, 1.0))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+
+        lines = self._registry.render().splitlines()
+        self.assertIn('# TYPE duration_seconds histogram', lines)
+        self.assertIn('duration_seconds_bucket{le="0.1"} 1.0', lines)
+        self.assertIn('duration_seconds_bucket{le="1.0"} 2.0', lines)
+        self.assertIn('duration_seconds_bucket{le="+Inf"} 3.0', lines)
+        self.assertIn('duration_seconds_count 3.0', lines)
+        self.assertIn('duration_seconds_sum 5.55', lines)
+
+    def test_gauge(self):
+        self._registry.gauge('filter_bytes', 'Bytes', lambda: None)
+        lines = self._registry.render().splitlines()
+        self.assertIn('# TYPE filter_bytes gauge', lines)
+        self.assertFalse([line for line in lines if line.startswith('filter_bytes ')])
+
+    def test_function_counter(self):
+        self._registry.function_counter('checks_total', 'Checks', lambda: 3)
+        lines = self._registry.render().splitlines()
+        self.assertIn('# TYPE checks_total counter', lines)
+        self.assertIn('checks_total 3.0', lines)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import unittest
+import time
+from decimal import Decimal
+from mock import patch
+
+import upay.common
+import upay.server.prevalidation
+from upay.server.prevalidation import PrevalidationError
+
+
+def tokens(*values):
+    return [upay.common.Token(Decimal(value)) for value in values]
+
+
+class PrevalidationTest(unittest.TestCase):
+
+    def setUp(self):
+        self._t0 = time.time()
+
+    def assertRejected(self, reason, input_tokens, output_tokens, config={}):
+        with self.assertRaises(PrevalidationError) as context:
+            upay.server.prevalidation.check_transform(input_tokens, output_tokens, config)
+        self.assertEquals(context.exception.reason, reason)
+
+    def test_transform(self):
+        upay.server.prevalidation.check_transform(tokens(1, 2), tokens(3), {})
+
+    def test_value_mismatch(self):
+        self.assertRejected('value_mismatch', tokens(1, 2), tokens(2))
+
+    def test_duplicate_hash(self):
+        input_tokens = tokens(1)
+        self.assertRejected('duplicate_hash', input_tokens, input_tokens)
+
+    @patch('time.time')
+    def test_created_in_future(self, time_mock):
+        time_mock.return_value = self._t0 + 3600
+        output_tokens = tokens(1)
+        time_mock.return_value = self._t0
+        self.assertRejected('created_in_future', tokens(1), output_tokens)
+
+    @patch('time.time')
+    def test_too_old(self, time_mock):
+        time_mock.return_value = self._t0
+        input_tokens, output_tokens = tokens(1), tokens(1)
+        time_mock.return_value = self._t0 + 3600
+
+        # Old tokens may be restored
+        upay.server.prevalidation.check_transform(input_tokens, output_tokens, {})
+        self.assertRejected('too_old', input_tokens, output_tokens,
+                            {'ALLOW_TOKEN_RESTORE': False})
+
+    def test_create(self):
+        upay.server.prevalidation.check_create(['1'] * 3, {'CREATE_MAX_TOKENS': 3})
+        with self.assertRaises(PrevalidationError):
+            upay.server.prevalidation.check_create(['1'] * 4, {'CREATE_MAX_TOKENS': 3})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import unittest
+import logging
+import os
+import shutil
+import tempfile
+from decimal import Decimal
+
+import upay.common
+import upay.server.token_authority
+
+
+class ReplicaTest(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig(level=logging.ERROR)
+        self._directory = tempfile.mkdtemp()
+        self._primary_url = 'sqlite:///' + os.path.join(self._directory, 'primary.db')
+        self._replica_url = 'sqlite:///' + os.path.join(self._directory, 'replica.db')
+        self.config = {
+            'DATABASE_URL': self._primary_url,
+            'DATABASE_REPLICA_URLS': [self._replica_url],
+            'DATABASE_REPLICA_ISOLATION_LEVEL': 'SERIALIZABLE',
+            'DATABASE_ALLOW_BOOTSTRAP': True
+        }
+        upay.server.token_authority.TokenAuthority(
+            dict(DATABASE_URL=self._replica_url, DATABASE_ALLOW_BOOTSTRAP=True)).bootstrap_db()
+
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+
+    def _token_authority(self, **config):
+        ta = upay.server.token_authority.TokenAuthority(dict(self.config, **config))
+        ta.bootstrap_db()
+        ta.check_health()
+        return ta
+
+    def test_read_session_uses_replica(self):
+        ta = self._token_authority()
+        with ta.read_session() as session:
+            self.assertIsNot(session._engine, ta._primary_engine)
+        self.assertEquals(ta.replica_stats(), {'total': 1, 'healthy': 1})
+
+    def test_unchecked_replica_not_used(self):
+        ta = upay.server.token_authority.TokenAuthority(self.config)
+        with ta.read_session() as session:
+            self.assertIs(session._engine, ta._primary_engine)
+
+    def test_stale_check(self):
+        ta = self._token_authority(HEALTH_CHECK_MAX_AGE=0)
+        with ta.read_session() as session:
+            self.assertIs(session._engine, ta._primary_engine)
+        self.assertEquals(ta.replica_stats(), {'total': 1, 'healthy': 0})
+
+    def test_recheck_misses_on_primary(self):
+        ta = self._token_authority()
+        tokens = [upay.common.Token(Decimal(1)), upay.common.Token(Decimal(2))]
+        with ta.session() as session:
+            session.connect()
+            session.create_tokens(tokens)
+            session.commit()
+
+        with ta.read_session() as session:
+            session.connect()
+            self.assertEquals(session.validate_tokens(tokens), tokens)
+
+    def test_no_recheck(self):
+        ta = self._token_authority(DATABASE_REPLICA_RECHECK_MISSES=False)
+        token = upay.common.Token(Decimal(1))
+        with ta.session() as session:
+            session.connect()
+            session.create_token(token)
+            session.commit()
+
+        with ta.read_session() as session:
+            session.connect()
+            self.assertEquals(session.validate_tokens([token]), [])
+
+    def test_fall_back_to_primary(self):
+        ta = self._token_authority(DATABASE_REPLICA_URLS=['sqlite:////nonexistent/replica.db'])
+        with ta.read_session() as session:
+            self.assertIs(session._engine, ta._primary_engine)
+        self.assertEquals(ta.replica_stats(), {'total': 1, 'healthy': 0})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import unittest
+import json
+from mock import patch
+from flask import Flask
+
+import upay.server.serialization as serialization
+
+
+class SerializationTest(unittest.TestCase):
+
+    def setUp(self):
+        self._app = Flask(__name__)
+
+    def _request(self, data, content_type):
+        return self._app.test_request_context('/', method='POST', data=data,
+                                              content_type=content_type)
+
+    def test_json(self):
+        body = {'tokens': [{'value': '001.00'}]}
+        with self._request(json.dumps(body), 'application/json') as context:
+            wire_format = serialization.request_format(context.request)
+            self.assertEquals(wire_format, serialization.JSON)
+            self.assertEquals(serialization.decode_request(context.request, wire_format), body)
+
+    def test_not_json(self):
+        with self._request('{}', 'text/plain') as context:
+            self.assertIsNone(serialization.decode_request(context.request, serialization.JSON))
+
+    def test_invalid_json(self):
+        with self._request('{', 'application/json') as context:
+            with self.assertRaises(serialization.ValidationError):
+                serialization.decode_request(context.request, serialization.JSON)
+
+    def test_strings_response(self):
+        strings = [json.dumps({'value': '001.00', 'hash': 'a"b'}), '{}']
+        response = serialization.strings_response('valid_tokens', iter(strings), serialization.JSON)
+        self.assertEquals(response.mimetype, 'application/json')
+        self.assertEquals(json.loads(response.get_data()), {'valid_tokens': strings})
+
+    @unittest.skipIf(serialization.msgpack is None, "msgpack is not installed")
+    def test_msgpack(self):
+        body = {u'tokens': [{u'value': u'001.00'}]}
+        with self._request(serialization.msgpack.packb(body), 'application/msgpack') as context:
+            wire_format = serialization.request_format(context.request)
+            self.assertEquals(wire_format, serialization.MSGPACK)
+            self.assertEquals(serialization.decode_request(context.request, wire_format), body)
+
+        response = serialization.strings_response('valid_tokens', ['{}'], wire_format)
+        self.assertEquals(serialization.msgpack.unpackb(response.get_data(), raw=False),
+                          {u'valid_tokens': [u'{}']})
+
+    @patch('upay.server.serialization.msgpack', None)
+    def test_msgpack_missing(self):
+        with self._request('', 'application/msgpack') as context:
+            with self.assertRaises(serialization.UnsupportedMediaTypeError):
+                serialization.request_format(context.request)
+
+if __name__ == '__main__':
+    unittest.main()
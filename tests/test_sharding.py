@@ -0,0 +1,159 @@
+import unittest
+import logging
+from datetime import datetime, timedelta
+from decimal import Decimal
+from mock import patch, Mock
+
+import upay.common
+import upay.server.sharding
+import upay.server.token_authority
+
+
+def db_config():
+    config = {
+        'DATABASE_SHARDS': ['sqlite:///:memory:', 'sqlite:///:memory:'],
+        'DATABASE_SHARDS_TWO_PHASE': False,
+        'DATABASE_ALLOW_BOOTSTRAP': True
+    }
+    return config
+
+
+class ShardedTokenAuthorityTest(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig(level=logging.ERROR)
+        self._ta = upay.server.sharding.ShardedTokenAuthority(db_config())
+        self._ta.bootstrap_db()
+        self._session = self._ta.session()
+        self._session.connect()
+
+    def tearDown(self):
+        self._session.disconnect()
+
+    def _tokens(self, shard_index, count):
+        tokens = []
+        while len(tokens) < count:
+            token = upay.common.Token(Decimal(1))
+            if self._ta.shard_index(token) == shard_index:
+                tokens.append(token)
+        return tokens
+
+    def test_routing(self):
+        tokens = self._tokens(0, 2) + self._tokens(1, 2)
+        self._session.create_tokens(tokens)
+        self._session.commit()
+
+        self.assertEquals(self._session.validate_tokens(tokens), tokens)
+        self.assertEquals(self._session._shards[0].validate_tokens(tokens), tokens[:2])
+        self.assertEquals(self._session._shards[1].validate_tokens(tokens), tokens[2:])
+
+    def test_cross_shard_transform(self):
+        tokens = self._tokens(0, 2)
+        self._session.create_tokens(tokens)
+        self._session.commit()
+
+        tokens2 = self._tokens(1, 2)
+        self._session.transform_tokens(tokens, tokens2)
+        self._session.commit()
+
+        self.assertEquals(self._session.validate_tokens(tokens + tokens2), tokens2)
+
+    def test_cross_shard_transform_bad(self):
+        tokens = self._tokens(0, 1) + self._tokens(1, 1)
+        self._session.create_tokens(tokens[:1])
+        self._session.commit()
+
+        tokens2 = self._tokens(0, 2)
+        self.assertRaises(upay.server.token_authority.NoValidTokenFoundError,
+                          self._session.transform_tokens, tokens, tokens2)
+        self._session.rollback()
+
+        self.assertEquals(self._session.validate_tokens(tokens + tokens2), tokens[:1])
+
+    def _prepare(self, shard, xids):
+        """Let shard report xids as prepared until they are finished."""
+        prepared = list(xids)
+        finished = []
+
+        def finish_prepared(xid, commit):
+            prepared.remove(xid)
+            finished.append((xid, commit))
+
+        return (patch.object(shard, 'prepared_transactions', side_effect=lambda age: prepared[:]),
+                patch.object(shard, 'finish_prepared', side_effect=finish_prepared),
+                finished)
+
+    def test_recover(self):
+        decisions = upay.server.sharding._decisions
+        engine = self._ta._shards[0]._engine
+        engine.execute(decisions.insert(), [
+            {'xid': 'decided', 'decided': datetime.utcnow() - timedelta(hours=1)}])
+
+        prepared, finish, finished = self._prepare(self._ta._shards[0], ['decided', 'undecided'])
+        with prepared, finish, \
+             patch.object(self._ta._shards[1], 'prepared_transactions', return_value=[]):
+            self._ta.recover()
+
+        self.assertEquals(finished, [('decided', True), ('undecided', False)])
+        self.assertEquals(engine.execute(decisions.select()).fetchall(), [])
+
+    def test_recover_keeps_failed_decision(self):
+        decisions = upay.server.sharding._decisions
+        engine = self._ta._shards[0]._engine
+        engine.execute(decisions.insert(), [
+            {'xid': 'decided', 'decided': datetime.utcnow() - timedelta(hours=1)}])
+
+        finished = []
+
+        def finish_prepared(xid, commit):
+            finished.append((xid, commit))
+            raise RuntimeError("connection lost")
+
+        with patch.object(self._ta._shards[0], 'prepared_transactions', return_value=['decided']), \
+             patch.object(self._ta._shards[0], 'finish_prepared', side_effect=finish_prepared), \
+             patch.object(self._ta._shards[1], 'prepared_transactions', return_value=[]):
+            self._ta.recover()
+            self._ta.recover()
+
+        self.assertEquals(finished, [('decided', True), ('decided', True)])
+        self.assertEquals(len(engine.execute(decisions.select()).fetchall()), 1)
+
+
+class TwoPhaseCommitTest(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig(level=logging.CRITICAL)
+        ta = upay.server.sharding.ShardedTokenAuthority(db_config())
+        self._session = ta.session()
+        self._session._two_phase = True
+        self._calls = Mock()
+        self._session._shards = [self._calls.shard0, self._calls.shard1]
+        for index, shard in enumerate(self._session._shards):
+            shard._transaction.xid = 'x%d' % index
+
+    def _commit(self):
+        with patch.object(self._session, '_record_decision', self._calls.record), \
+             patch.object(self._session, '_forget_decision', self._calls.forget):
+            self._session.commit()
+
+    def test_commit(self):
+        self._commit()
+
+        calls = self._calls
+        self.assertEquals([name for name, args, kwargs in calls.mock_calls],
+                          ['shard0.prepare', 'shard1.prepare', 'record',
+                           'shard0.commit', 'shard1.commit', 'forget'])
+        calls.record.assert_called_once_with(['x0', 'x1'])
+        calls.forget.assert_called_once_with(['x0', 'x1'])
+
+    def test_failed_prepare(self):
+        self._calls.shard1.prepare.side_effect = RuntimeError("prepare failed")
+
+        self.assertRaises(RuntimeError, self._commit)
+
+        calls = self._calls
+        self.assertEquals([name for name, args, kwargs in calls.mock_calls],
+                          ['shard0.prepare', 'shard1.prepare', 'shard0.rollback', 'shard1.rollback'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -37,6 +37,15 @@ class TokenAuthorityTestsTest(unittest.TestCase):
         request = {"token": [t1, t2]}
         self.assertRaises(jsonschema.ValidationError, upay.server.schemas.validate_validate, request)
 
+    def test_validation_large(self):
+        tokens = [json.loads(str(upay.common.Token(Decimal(1)))) for x in range(1000)]
+
+        request = {"tokens": tokens}
+        upay.server.schemas.validate_validate(request)
+
+        request = {"tokens": tokens + [dict(tokens[500])]}
+        self.assertRaises(jsonschema.ValidationError, upay.server.schemas.validate_validate, request)
+
     def test_transform(self):
         t1 = json.loads(str(upay.common.Token(Decimal(1))))
         t2 = json.loads(str(upay.common.Token(Decimal(1))))
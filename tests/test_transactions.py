@@ -0,0 +1,54 @@
+import unittest
+from mock import patch, Mock
+
+import sqlalchemy.exc
+
+import upay.server.transactions
+
+
+class PgError(Exception):
+    def __init__(self, pgcode):
+        self.pgcode = pgcode
+
+
+def conflict(pgcode='40001'):
+    return sqlalchemy.exc.OperationalError('UPDATE tokens', {}, PgError(pgcode))
+
+
+@patch('time.sleep')
+class RunInTransactionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.config = {'TRANSACTION_MAX_RETRIES': 2}
+        self.session = Mock()
+
+    def test_success(self, sleep_mock):
+        work = Mock(return_value=1)
+        self.assertEquals(upay.server.transactions.run_in_transaction(
+            self.session, work, self.config, 'test'), 1)
+        self.assertEquals(self.session.commit.call_count, 1)
+        self.assertEquals(sleep_mock.call_count, 0)
+
+    def test_retry(self, sleep_mock):
+        work = Mock(side_effect=[conflict(), conflict('40P01'), 1])
+        self.assertEquals(upay.server.transactions.run_in_transaction(
+            self.session, work, self.config, 'test'), 1)
+        self.assertEquals(self.session.rollback.call_count, 2)
+        self.assertEquals(sleep_mock.call_count, 2)
+
+    def test_retries_exhausted(self, sleep_mock):
+        work = Mock(side_effect=conflict())
+        self.assertRaises(upay.server.transactions.TransactionConflictError,
+                          upay.server.transactions.run_in_transaction,
+                          self.session, work, self.config, 'test')
+        self.assertEquals(work.call_count, 3)
+
+    def test_other_errors(self, sleep_mock):
+        work = Mock(side_effect=conflict('23505'))
+        self.assertRaises(sqlalchemy.exc.OperationalError,
+                          upay.server.transactions.run_in_transaction,
+                          self.session, work, self.config, 'test')
+        self.assertEquals(work.call_count, 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import unittest
+import threading
+
+from flask import Flask
+
+import upay.server.utils
+
+
+class StripedLockTest(unittest.TestCase):
+
+    def setUp(self):
+        self._lock = upay.server.utils.StripedLock(16)
+
+    def test_reentrant(self):
+        with self._lock.locked(['a', 'b']):
+            with self._lock.locked(['b']):
+                pass
+
+    def test_released(self):
+        with self._lock.locked(['a', 'b', 'c']):
+            pass
+        for lock in self._lock._locks:
+            self.assertTrue(lock.acquire(False))
+            lock.release()
+
+    def test_disjoint_keys_do_not_block(self):
+        keys_a = ['a']
+        keys_b = [key for key in map(str, range(100))
+                    if self._lock._stripes([key]) != self._lock._stripes(keys_a)][:1]
+        acquired = []
+
+        def other():
+            with self._lock.locked(keys_b):
+                acquired.append(True)
+
+        with self._lock.locked(keys_a):
+            thread = threading.Thread(target=other)
+            thread.start()
+            thread.join(5)
+        self.assertEquals(acquired, [True])
+
+
+class ExtensionTest(unittest.TestCase):
+
+    def setUp(self):
+        self._app = Flask(__name__)
+
+    def test_created_once(self):
+        created = []
+        with self._app.app_context():
+            for x in range(2):
+                upay.server.utils._get_extension('test', lambda: created.append(1) or object())
+        self.assertEquals(len(created), 1)
+
+    def test_slow_factory_does_not_block_others(self):
+        started = threading.Event()
+        release = threading.Event()
+        found = []
+
+        def slow():
+            started.set()
+            release.wait(5)
+            return 'slow'
+
+        def create_slow():
+            with self._app.app_context():
+                upay.server.utils._get_extension('slow', slow)
+
+        thread = threading.Thread(target=create_slow)
+        thread.start()
+        try:
+            self.assertTrue(started.wait(5))
+            with self._app.app_context():
+                found.append(upay.server.utils._get_extension('other', lambda: 'other'))
+        finally:
+            release.set()
+            thread.join(5)
+        self.assertEquals(found, ['other'])
+
+if __name__ == '__main__':
+    unittest.main()
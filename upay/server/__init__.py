@@ -1,16 +1,41 @@
-from flask import Flask, make_response, jsonify
+# Flask and the API are only imported by create_app(), so the command line
+# tools can import upay.server.* without paying for them.
 
-app = Flask(__name__)
-app.config.from_envvar('UPAY_SERVER_CONFIG', True)
 
-# utilities
-from .utils import initialize_logging
-initialize_logging()
+def create_app(config=None):
+    """Create the Flask app serving the API.
 
-# import implementation modules
-import api_v1
+    The configuration is read from the file named by UPAY_SERVER_CONFIG
+    and updated with config. With PRELOAD_DATABASE set, the connection
+    pool (and the token filter) are set up right away, e.g. before a
+    pre-forking server forks its workers.
+    """
+    from flask import Flask, make_response, jsonify
 
-@app.errorhandler(404)
-def not_found(error):
-    return make_response(jsonify({'error': 'Not found'} ), 404)
+    from .config import load_config
+    from .log import initialize_logging
+    from .utils import get_token_authority
+    from .api_v1 import api
 
+    app = Flask(__name__)
+    app.config.update(load_config())
+    if config is not None:
+        app.config.update(config)
+
+    initialize_logging(app.config)
+
+    app.register_blueprint(api)
+
+    @app.errorhandler(404)
+    def not_found(error):
+        return make_response(jsonify({'error': 'Not found'} ), 404)
+
+    if app.config.get('PRELOAD_DATABASE'):
+        with app.app_context():
+            get_token_authority()
+
+    return app
+
+
+def run():
+    create_app().run()
@@ -0,0 +1,93 @@
+import threading
+from collections import OrderedDict
+from timeit import default_timer as clock
+
+from . import metrics
+
+rejected = metrics.registry.counter('upay_admission_rejected_total',
+    'Requests turned away by rate limiting or admission control', ['endpoint', 'reason'])
+
+
+class RateLimiter(object):
+    """A token bucket per client.
+
+    Every client may send burst requests at once and rate requests per
+    second on average. Buckets of at most max_clients clients are kept;
+    the least recently seen client is forgotten first, which only makes
+    its bucket full again.
+    """
+
+    def __init__(self, rate, burst=None, max_clients=10000):
+        self.rate = float(rate)
+        self.burst = burst if burst is not None else max(1, rate)
+        self.max_clients = max_clients
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, client):
+        """Take a token from the bucket of client.
+
+        Returns 0 if the request may pass, otherwise the number of
+        seconds until the next token is available.
+        """
+        now = clock()
+        with self._lock:
+            tokens, updated = self._buckets.pop(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / self.rate
+            self._buckets[client] = (tokens, now)
+            while len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+        return wait
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class AdmissionQueue(object):
+    """Limits the number of requests working at the same time.
+
+    At most max_active requests are admitted at once, up to max_waiting
+    more wait for at most timeout seconds. Requests beyond that are
+    turned away right away instead of adding to the latency of all
+    others.
+    """
+
+    def __init__(self, max_active, max_waiting=None, timeout=1.0):
+        self.max_active = max_active
+        self.max_waiting = max_waiting if max_waiting is not None else 2 * max_active
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """Return True once the request is admitted, False if the queue
+        is full or the timeout passed."""
+        with self._condition:
+            if self.active < self.max_active:
+                self.active += 1
+                return True
+            if self.waiting >= self.max_waiting:
+                return False
+            self.waiting += 1
+            try:
+                deadline = clock() + self.timeout
+                while self.active >= self.max_active:
+                    remaining = deadline - clock()
+                    if remaining <= 0:
+                        return False
+                    self._condition.wait(remaining)
+                self.active += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
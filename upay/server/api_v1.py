@@ -1,100 +1,327 @@
-from flask import make_response, jsonify, request
+import hmac
+import json
+import hashlib
+from flask import Blueprint, Response, current_app, make_response, jsonify, request, \
+                  stream_with_context
 from jsonschema import ValidationError
 from decimal import Decimal
 
 from upay.common import Token
 
-from . import app
-from .utils import get_global_lock
-from .token_authority import TokenAuthority, NoValidTokenFoundError
+from .utils import lock_tokens, get_token_authority, instrument, \
+                   admit, token_filter_stats, get_health_monitor, get_group_committer
+from .transactions import run_in_transaction, TransactionConflictError
+from .group_commit import DatabaseUnavailableError
 from . import schemas
+from . import prevalidation
+from . import serialization
+from . import metrics
 
+api = Blueprint('api_v1', __name__)
 
-@app.route('/api/v1.0/status', methods=['GET'])
-@get_global_lock
+
+def _validation_error(endpoint, ex):
+    current_app.log_exception(ex)
+    metrics.errors.inc(endpoint, 'ValidationError')
+    return make_response(jsonify(
+        {'validation-error': str(ex)}), 400)
+
+
+def _no_connection(endpoint, ex):
+    current_app.log_exception(ex)
+    metrics.errors.inc(endpoint, 'NoConnection')
+    return make_response(jsonify(
+        {'internal-error': 'No connection to the database'}), 503)
+
+
+@api.app_errorhandler(TransactionConflictError)
+def transaction_conflict(error):
+    response = make_response(jsonify(
+        {'internal-error': 'Too many concurrent requests for these tokens'}), 503)
+    response.headers['Retry-After'] = '1'
+    return response
+
+
+@api.app_errorhandler(serialization.UnsupportedMediaTypeError)
+def unsupported_media_type(error):
+    return make_response(jsonify({'error': str(error)}), 415)
+
+
+def _token_filter_stat(name):
+    def value():
+        stats = token_filter_stats()
+        return None if stats is None else stats[name]
+    return value
+
+metrics.registry.gauge('upay_token_filter_bytes',
+    'Memory used by the token filter', _token_filter_stat('size_bytes'))
+metrics.registry.function_counter('upay_token_filter_checks_total',
+    'Tokens checked against the token filter', _token_filter_stat('checks'))
+metrics.registry.function_counter('upay_token_filter_rejected_total',
+    'Tokens rejected by the token filter without a database query', _token_filter_stat('rejected'))
+
+
+@api.before_app_request
+def start_health_monitor():
+    """The health monitor also checks the read replicas, so it has to run
+    before the first request chooses one. It is not needed to tell that
+    the process is alive or to export the metrics."""
+    if request.endpoint not in ('api_v1.live', 'api_v1.export_metrics'):
+        get_health_monitor().start()
+
+
+@api.route('/api/v1.0/status', methods=['GET'])
+@instrument('status')
 def status():
-    database_status = 'DOWN'
-    return_code = 503
-    try:
-        token_authority = TokenAuthority(app.config)
-        token_authority.connect()
-        database_status = 'OK'
-        return_code = 200
-        token_authority.disconnect()
-    except Exception as ex:
-        app.log_exception(ex)
+    """Report the last result of the background database check along with
+    the connection pool usage. Neither touches the database."""
+    healthy, age = get_health_monitor().status()
+    if age is None:
+        result = {'database': 'UNKNOWN', 'checked': None}
+    else:
+        result = {'database': 'OK' if healthy else 'DOWN', 'checked': round(age, 3)}
+
+    token_authority = current_app.extensions.get('upay', {}).get('token_authority')
+    if token_authority is not None:
+        pool = token_authority.pool_stats()
+        if pool is not None:
+            result['pool'] = pool
+        replicas = token_authority.replica_stats()
+        if replicas is not None:
+            result['replicas'] = replicas
+    return make_response(jsonify(result), 200 if healthy else 503)
+
+
+@api.route('/api/v1.0/health/live', methods=['GET'])
+def live():
+    return make_response(jsonify({'status': 'OK'}))
 
-    return make_response(jsonify({'database': database_status}), return_code)
 
+@api.route('/api/v1.0/health/ready', methods=['GET'])
+def ready():
+    healthy, age = get_health_monitor().status()
+    return make_response(jsonify({'status': 'OK' if healthy else 'DOWN'}),
+                         200 if healthy else 503)
 
-@app.route('/api/v1.0/validate', methods=['POST'])
-@get_global_lock
+
+@api.route('/api/v1.0/metrics', methods=['GET'])
+def export_metrics():
+    response = make_response(metrics.registry.render())
+    response.mimetype = 'text/plain'
+    return response
+
+
+@api.route('/api/v1.0/validate', methods=['POST'])
+@instrument('validate')
+@admit('validate')
 def validate_tokens():
+    wire_format = serialization.request_format(request)
     try:
-        schemas.validate_validate(request.json)
+        with metrics.stage_duration.time('schema'):
+            body = serialization.decode_request(request, wire_format)
+            schemas.validate_validate(body)
     except ValidationError as ex:
-        app.log_exception(ex)
-        return make_response(jsonify(
-            {'validation-error': str(ex)}), 400)
+        return _validation_error('validate', ex)
+
+    tokens = map(Token, body['tokens'])
+    with lock_tokens(tokens):
+        try:
+            with metrics.stage_duration.time('connect'):
+                token_authority = get_token_authority().read_session()
+                token_authority.connect()
+        except Exception as ex:
+            return _no_connection('validate', ex)
+
+        with token_authority:
+            valid_tokens = run_in_transaction(token_authority,
+                lambda ta: ta.validate_tokens(tokens), current_app.config, 'validate')
+    return serialization.strings_response('valid_tokens', (str(t) for t in valid_tokens),
+                                          wire_format)
+
+
+def _read_stream_batches(stream, batch_size):
+    """Parse NDJSON tokens from stream, yielding lists of at most
+    batch_size (line number, token or error message) tuples."""
+    batch = []
+    for number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            item = serialization.loads(line)
+            schemas.validate_token(item)
+            batch.append((number, Token(item)))
+        except (ValueError, ValidationError) as ex:
+            batch.append((number, str(ex)))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
 
-    tokens = map(Token, request.json['tokens'])
-    valid_tokens = []
+@api.route('/api/v1.0/validate/stream', methods=['POST'])
+@instrument('validate_stream')
+@admit('validate_stream')
+def validate_tokens_stream():
+    """Validate tokens sent as one JSON object per line.
+
+    The result is streamed back as one JSON object per token while the
+    request is still being read, so memory use does not grow with the
+    number of tokens.
+    """
     try:
-        token_authority = TokenAuthority(app.config)
+        token_authority = get_token_authority().read_session()
         token_authority.connect()
     except Exception as ex:
-        app.log_exception(ex)
-        return make_response(jsonify(
-            {'internal-error': 'No connection to the database'}), 503)
+        return _no_connection('validate_stream', ex)
 
-    for token in tokens:
-        try:
-            token_authority.validate_token(token)
-            valid_tokens.append(token)
-        except NoValidTokenFoundError:
-            pass
+    config = current_app.config
+    batch_size = config.get('STREAM_BATCH_SIZE', 500)
+
+    def generate():
+        with token_authority:
+            for batch in _read_stream_batches(request.stream, batch_size):
+                tokens = [item for number, item in batch if isinstance(item, Token)]
+                with lock_tokens(tokens):
+                    valid_tokens = set(map(id, run_in_transaction(token_authority,
+                        lambda ta: ta.validate_tokens(tokens), config, 'validate_stream')))
+                for number, item in batch:
+                    if isinstance(item, Token):
+                        result = {'token': str(item), 'valid': id(item) in valid_tokens}
+                    else:
+                        result = {'line': number, 'validation-error': item}
+                    yield json.dumps(result) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+def _write(work, name):
+    """Run work(token_authority) in a committed transaction, shared with
+    concurrent requests if GROUP_COMMIT is set. Raises
+    DatabaseUnavailableError if the database can not be reached."""
+    try:
+        with metrics.stage_duration.time('connect'):
+            group_committer = get_group_committer()
+            if group_committer is None:
+                token_authority = get_token_authority().session()
+                token_authority.connect()
+    except Exception as ex:
+        raise DatabaseUnavailableError(ex)
+
+    if group_committer is not None:
+        with metrics.stage_duration.time('group_commit'):
+            return group_committer.submit(work, name)
 
-    token_authority.commit()
-    return make_response(jsonify({'valid_tokens': map(str, valid_tokens)}))
+    with token_authority:
+        return run_in_transaction(token_authority, work, current_app.config, name)
 
 
-@app.route('/api/v1.0/transform', methods=['POST'])
-@get_global_lock
+@api.route('/api/v1.0/transform', methods=['POST'])
+@instrument('transform')
+@admit('transform')
 def transform_tokens():
+    wire_format = serialization.request_format(request)
     try:
-        schemas.validate_transform(request.json)
+        with metrics.stage_duration.time('schema'):
+            body = serialization.decode_request(request, wire_format)
+            schemas.validate_transform(body)
     except ValidationError as ex:
-        app.log_exception(ex)
-        return make_response(jsonify(
-            {'validation-error': str(ex)}), 400)
+        return _validation_error('transform', ex)
 
-    input_tokens = map(Token, request.json['input_tokens'])
-    output_tokens = map(Token, request.json['output_tokens'])
+    input_tokens = map(Token, body['input_tokens'])
+    output_tokens = map(Token, body['output_tokens'])
 
-    try:
-        token_authority = TokenAuthority(app.config)
-        token_authority.connect()
-    except Exception as ex:
-        app.log_exception(ex)
+    # A retried request with the same Idempotency-Key gets the result of
+    # the first one, which is stored in the same transaction.
+    idempotency_key = request.headers.get('Idempotency-Key')
+    if idempotency_key is not None and len(idempotency_key) > 255:
+        return _validation_error('transform',
+                                 ValidationError('Idempotency-Key is too long'))
+    fingerprint = hashlib.sha256(json.dumps(body, sort_keys=True)).hexdigest()
+    ttl = current_app.config.get('IDEMPOTENCY_TTL', 3600)
+
+    def transform(ta):
+        if idempotency_key is not None:
+            stored = ta.find_idempotent_result(idempotency_key)
+            if stored is not None:
+                return stored + (True,)
+        ta.transform_tokens(input_tokens, output_tokens)
+        transformed_tokens = map(str, output_tokens)
+        if idempotency_key is not None:
+            ta.store_idempotent_result(idempotency_key, fingerprint, transformed_tokens, ttl)
+        return fingerprint, transformed_tokens, False
+
+    with lock_tokens(input_tokens + output_tokens):
+        try:
+            prevalidation.check_transform(input_tokens, output_tokens, current_app.config)
+        except prevalidation.PrevalidationError as ex:
+            prevalidation.rejected.inc('transform', ex.reason)
+            return _validation_error('transform', ex)
+
+        try:
+            stored_fingerprint, transformed_tokens, replayed = _write(transform, 'transform')
+        except DatabaseUnavailableError as ex:
+            return _no_connection('transform', ex)
+
+    if stored_fingerprint != fingerprint:
+        metrics.errors.inc('transform', 'IdempotencyKeyReused')
         return make_response(jsonify(
-            {'internal-error': 'No connection to the database'}), 503)
+            {'idempotency-error': 'Idempotency-Key used for a different request'}), 422)
+    response = serialization.strings_response('transformed_tokens', transformed_tokens,
+                                              wire_format)
+    if replayed:
+        metrics.idempotent_replays.inc()
+        response.headers['Idempotent-Replayed'] = 'true'
+    return response
 
-    token = token_authority.merge_tokens(input_tokens)
-    token_authority.split_token(token, output_tokens)
-    token_authority.commit()
 
-    return make_response(jsonify({'transformed_tokens': map(str, output_tokens)}))
+def _digest(key):
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return hashlib.sha256(key).digest()
 
 
-@app.route('/api/v1.0/create', methods=['POST'])
-@get_global_lock
+def _authorized_for_create():
+    """Check the API key sent as 'Authorization: Bearer <key>' against
+    CREATE_API_KEYS."""
+    authorization = request.headers.get('Authorization', '')
+    if not authorization.startswith('Bearer '):
+        return False
+    key = _digest(authorization[len('Bearer '):].strip())
+    return any(hmac.compare_digest(key, _digest(valid_key))
+                   for valid_key in current_app.config['CREATE_API_KEYS'])
+
+
+@api.route('/api/v1.0/create', methods=['POST'])
+@instrument('create')
+@admit('create')
 def create_tokens():
+    if not current_app.config.get('CREATE_API_KEYS'):
+        metrics.errors.inc('create', 'Forbidden')
+        return make_response(jsonify(
+            {'error': 'Creating tokens is disabled'}), 403)
+    if not _authorized_for_create():
+        metrics.errors.inc('create', 'Unauthorized')
+        return make_response(jsonify(
+            {'error': 'Invalid or missing API key'}), 401)
+
     try:
-        schemas.validate_create(request.json)
+        with metrics.stage_duration.time('schema'):
+            schemas.validate_create(request.json)
     except ValidationError as ex:
-        app.log_exception(ex)
-        return make_response(jsonify(
-            {'validation-error': str(ex)}), 400)
+        return _validation_error('create', ex)
+
+    try:
+        prevalidation.check_create(request.json['values'], current_app.config)
+    except prevalidation.PrevalidationError as ex:
+        prevalidation.rejected.inc('create', ex.reason)
+        return _validation_error('create', ex)
 
     created_tokens = map(lambda value: Token(Decimal(value)), request.json['values'])
+
+    try:
+        _write(lambda ta: ta.mint_tokens(created_tokens), 'create')
+    except DatabaseUnavailableError as ex:
+        return _no_connection('create', ex)
+
     return make_response(jsonify({'created_tokens': map(str, created_tokens)}))
@@ -0,0 +1,85 @@
+import math
+import threading
+
+
+class BloomFilter(object):
+    """A set of hash strings which can answer "definitely not contained".
+
+    The hash strings are expected to be hex encoded outputs of a
+    cryptographic hash function, so the bit positions are taken from them
+    directly instead of hashing them again.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self._size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self._hashes = max(1, int(round(math.log(2) * self._size / capacity)))
+        self._bits = bytearray((self._size + 7) // 8)
+        self._lock = threading.Lock()
+        self.count = 0
+
+    @property
+    def size_bytes(self):
+        return len(self._bits)
+
+    def _positions(self, hash_string):
+        # Double hashing: position i is (h1 + i * h2) mod size
+        h1 = int(hash_string[:16], 16)
+        h2 = int(hash_string[16:32], 16) | 1
+        return [(h1 + i * h2) % self._size for i in xrange(self._hashes)]
+
+    def add(self, hash_string):
+        positions = self._positions(hash_string)
+        with self._lock:
+            for position in positions:
+                self._bits[position >> 3] |= 1 << (position & 7)
+            self.count += 1
+
+    def __contains__(self, hash_string):
+        bits = self._bits
+        for position in self._positions(hash_string):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+class TokenFilter(object):
+    """Rejects tokens which never existed.
+
+    Holds the hashes of all tokens in the database when the filter was
+    built, including used and archived ones which may be restored by
+    another process, and of all tokens created by this process since.
+    Voided tokens can not be removed and only cost a database query as
+    before.
+
+    Tokens created after built are always passed on to the database, so
+    tokens created by other processes, e.g. other server workers or the
+    token-authority-create-tokens tool, are still found.
+    """
+
+    def __init__(self, capacity, error_rate, built):
+        self._filter = BloomFilter(capacity, error_rate)
+        self.built = built
+        self.checks = 0
+        self.rejected = 0
+
+    def add(self, hash_string):
+        self._filter.add(hash_string)
+
+    def might_be_valid(self, token):
+        self.checks += 1
+        if token.created > self.built or token.hash_string in self._filter:
+            return True
+        self.rejected += 1
+        return False
+
+    def stats(self):
+        return {
+            'size_bytes': self._filter.size_bytes,
+            'capacity': self._filter.capacity,
+            'error_rate': self._filter.error_rate,
+            'tokens': self._filter.count,
+            'checks': self.checks,
+            'rejected': self.rejected,
+        }
@@ -1,28 +1,103 @@
+import os
 import sys
+import time
+import argparse
 from decimal import Decimal
 
 from upay.common import Token
 
-from . import app
-from .token_authority import TokenAuthority
+from .config import load_config
+from .log import initialize_logging
+from .sharding import create_token_authority
+
+
+def _load_config():
+    """Load the configuration and set up logging from it, as the server
+    does."""
+    config = load_config()
+    initialize_logging(config)
+    return config
+
+
+def _count_complete_lines(path):
+    """Count the newline terminated lines of path and cut off a partial
+    last line, e.g. left by a crash while it was written."""
+    if not os.path.exists(path):
+        return 0
+    count = 0
+    complete = 0
+    with open(path, 'r+b') as f:
+        for line in f:
+            if not line.endswith('\n'):
+                break
+            count += 1
+            complete += len(line)
+        f.truncate(complete)
+    return count
 
 
 def create_tokens():
-    value = Decimal(sys.argv[1])
-    count = int(sys.argv[2])
+    parser = argparse.ArgumentParser(description='Create tokens and print them, one per line.')
+    parser.add_argument('value', type=Decimal, help='value of each token')
+    parser.add_argument('count', type=int, help='number of tokens to create')
+    parser.add_argument('-o', '--output',
+                        help='append the tokens to this file instead of printing them')
+    parser.add_argument('-b', '--batch-size', type=int, default=1000,
+                        help='number of tokens created per transaction (default: 1000)')
+    parser.add_argument('-r', '--resume', action='store_true',
+                        help='only create the tokens still missing in the output file')
+    args = parser.parse_args()
+
+    if args.resume and not args.output:
+        parser.error('--resume requires --output')
+
+    done = _count_complete_lines(args.output) if args.resume else 0
+    output = open(args.output, 'a') if args.output else sys.stdout
 
-    ta = TokenAuthority(app.config)
+    config = _load_config()
+    margin = config.get('TOKEN_FILTER_MARGIN', 600)
+    ta = create_token_authority(config)
     ta.connect()
 
-    tokens = [Token(value) for x in xrange(count)]
-    map(ta.create_token, tokens)
+    # Each batch is committed before it is written out. A crash in between
+    # loses at most one batch of valid tokens nobody received, but never
+    # hands out a token which is not in the database.
+    while done < args.count:
+        started = time.time()
+        tokens = [Token(args.value) for x in xrange(min(args.batch_size, args.count - done))]
+        ta.mint_tokens(tokens)
+        ta.commit()
+        if time.time() - started > margin:
+            # Token filters built meanwhile reject these tokens
+            sys.stderr.write('Warning: a batch took longer than TOKEN_FILTER_MARGIN (%d s) to '
+                             'commit. Restart the servers and use a smaller --batch-size.\n'
+                             % margin)
 
-    for token in tokens:
-        print token
+        output.write(''.join('%s\n' % token for token in tokens))
+        output.flush()
+        if output is not sys.stdout:
+            os.fsync(output.fileno())
 
-    ta.commit()
+        done += len(tokens)
+        sys.stderr.write('%d/%d tokens created\n' % (done, args.count))
+
+    ta.disconnect()
+    if output is not sys.stdout:
+        output.close()
 
 
 def bootstrap_db():
-    ta = TokenAuthority(app.config)
+    ta = create_token_authority(_load_config())
     ta.bootstrap_db()
+
+
+def migrate_db():
+    ta = create_token_authority(_load_config())
+    ta.migrate_db()
+
+
+def compact():
+    config = _load_config()
+    ta = create_token_authority(config)
+    ta.compact(config.get('ARCHIVE_RETENTION', 30 * 24 * 3600),
+               config.get('COMPACTION_BATCH_SIZE', 1000))
@@ -0,0 +1,18 @@
+import os
+
+
+def load_config(path=None):
+    """Read the configuration file at path, or the one named by the
+    UPAY_SERVER_CONFIG environment variable, without importing Flask.
+
+    Like Flask's Config.from_pyfile(), the file is executed as Python and
+    its upper case names become the configuration. Returns an empty
+    configuration if no file is given.
+    """
+    if path is None:
+        path = os.environ.get('UPAY_SERVER_CONFIG')
+        if not path:
+            return {}
+    namespace = {'__file__': path}
+    execfile(path, namespace)
+    return dict((key, value) for key, value in namespace.items() if key.isupper())
@@ -0,0 +1,123 @@
+import sys
+import logging
+import threading
+import Queue
+
+from . import metrics
+from .transactions import run_in_transaction
+
+group_size = metrics.registry.histogram('upay_group_commit_size',
+    'Number of requests committed together', buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+group_fallbacks = metrics.registry.counter('upay_group_commit_fallbacks_total',
+    'Groups rolled back and run one request per transaction because a request failed')
+
+
+class DatabaseUnavailableError(Exception):
+    """The committer could not connect to the database."""
+
+
+class _Request(object):
+    def __init__(self, work, name):
+        self.work = work
+        self.name = name
+        self.result = None
+        self.exc_info = None
+        self.done = threading.Event()
+
+
+class GroupCommitter(object):
+    """Runs the work of concurrent requests in one database transaction,
+    so they share a single commit and the flush to disk behind it.
+
+    A daemon thread waits for the first request, collects the requests
+    arriving within max_delay seconds, up to max_size of them, runs them
+    in order and commits. If one of them fails, the whole group is rolled
+    back and every request is run again in a transaction of its own, so a
+    failing request can not take others with it. submit() only returns
+    once the transaction holding the request is committed.
+    """
+
+    def __init__(self, token_authority, config):
+        self._token_authority = token_authority
+        self._config = config
+        self.max_size = config.get('GROUP_COMMIT_MAX_SIZE', 100)
+        self.max_delay = config.get('GROUP_COMMIT_MAX_DELAY', 0.002)
+        self._queue = Queue.Queue()
+        self._logger = logging.getLogger(__name__)
+        thread = threading.Thread(target=self._run, name='group-commit')
+        thread.daemon = True
+        thread.start()
+
+    def submit(self, work, name):
+        """Call work(token_authority) in the next group and return its
+        result, or raise its exception, once the group is committed."""
+        request = _Request(work, name)
+        self._queue.put(request)
+        request.done.wait()
+        if request.exc_info is not None:
+            raise request.exc_info[0], request.exc_info[1], request.exc_info[2]
+        return request.result
+
+    def _collect(self):
+        group = [self._queue.get()]
+        deadline = metrics.clock() + self.max_delay
+        while len(group) < self.max_size:
+            timeout = deadline - metrics.clock()
+            if timeout <= 0:
+                break
+            try:
+                group.append(self._queue.get(timeout=timeout))
+            except Queue.Empty:
+                break
+        return group
+
+    def _run(self):
+        while True:
+            group = self._collect()
+            try:
+                self._commit(group)
+            except Exception:
+                self._logger.error("Group commit failed", exc_info=True)
+                for request in group:
+                    if not request.done.is_set():
+                        request.exc_info = sys.exc_info()
+                        request.done.set()
+
+    def _commit(self, group):
+        group_size.observe(len(group))
+        try:
+            token_authority = self._token_authority.session()
+            token_authority.connect()
+        except Exception as ex:
+            self._logger.warning("Can not connect to the database", exc_info=True)
+            for request in group:
+                request.exc_info = (DatabaseUnavailableError, DatabaseUnavailableError(ex), None)
+                request.done.set()
+            return
+
+        with token_authority:
+            try:
+                results = run_in_transaction(token_authority,
+                    lambda ta: [request.work(ta) for request in group],
+                    self._config, group[0].name if len(group) == 1 else 'group_commit')
+            except Exception:
+                exc_info = sys.exc_info()
+                token_authority.rollback()
+                if len(group) == 1:
+                    group[0].exc_info = exc_info
+                    group[0].done.set()
+                    return
+                group_fallbacks.inc()
+                for request in group:
+                    try:
+                        request.result = run_in_transaction(token_authority,
+                            request.work, self._config, request.name)
+                    except Exception:
+                        request.exc_info = sys.exc_info()
+                        token_authority.rollback()
+                    request.done.set()
+                return
+
+        for request, result in zip(group, results):
+            request.result = result
+            request.done.set()
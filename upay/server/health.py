@@ -0,0 +1,66 @@
+import logging
+import os
+import threading
+import time
+
+
+class HealthMonitor(object):
+    """Calls probe() every interval seconds in a daemon thread and keeps
+    the outcome, so health checks can be answered without touching the
+    database.
+
+    probe() raises if the service is unhealthy. A result older than
+    max_age seconds, e.g. because probe() hangs, counts as unhealthy.
+    """
+
+    def __init__(self, probe, interval=5, max_age=None):
+        self._probe = probe
+        self.interval = interval
+        self.max_age = max_age if max_age is not None else 3 * interval
+        self._logger = logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._result = None
+        self._pid = None
+
+    def check(self):
+        """Run the probe once and store the result."""
+        try:
+            self._probe()
+            healthy = True
+        except Exception:
+            self._logger.warning("Health check failed", exc_info=True)
+            healthy = False
+        self._result = (healthy, time.time())
+        return healthy
+
+    def _run(self):
+        while True:
+            self.check()
+            time.sleep(self.interval)
+
+    def start(self):
+        """Start the prober unless it runs in this process already.
+
+        It does not wait for the first check; until there is a result the
+        service counts as unhealthy.
+        """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # Threads do not survive a fork, start a new one in the child
+            self._pid = os.getpid()
+            thread = threading.Thread(target=self._run, name='health')
+            thread.daemon = True
+            thread.start()
+
+    def status(self):
+        """Return whether the service is healthy and the age of the
+        result in seconds, which is None if it was not checked yet."""
+        result = self._result
+        if result is None:
+            return False, None
+        healthy, checked = result
+        age = time.time() - checked
+        return healthy and age <= self.max_age, age
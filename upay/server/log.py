@@ -0,0 +1,139 @@
+"""Logging helpers which keep log output off the request path.
+
+Python 2 has no logging.handlers.QueueHandler, so a minimal one is
+provided here.
+"""
+import os
+import Queue
+import random
+import logging
+import threading
+import logging.config
+
+from . import metrics
+
+dropped_records = metrics.registry.counter('upay_log_records_dropped_total',
+    'Log records dropped because the log queue was full')
+
+
+class SamplingFilter(logging.Filter):
+    """Passes only a fraction rate of the records at or below level.
+
+    Records above level, e.g. warnings, always pass.
+    """
+
+    def __init__(self, rate, level=logging.DEBUG):
+        logging.Filter.__init__(self)
+        self.rate = rate
+        self.level = level
+
+    def filter(self, record):
+        return record.levelno > self.level or random.random() < self.rate
+
+
+class QueueHandler(logging.Handler):
+    """Puts records into a queue of at most size records instead of
+    writing them. A QueueListener passes them on to handlers.
+
+    If the queue is full the record is dropped, so logging never blocks.
+    The message is formatted by the listener's handlers, so the arguments
+    of a record must not change after it was logged.
+
+    The listener thread is started by the first record logged in a
+    process, with a new queue, as threads do not survive a fork. This
+    way each worker of a pre-forking server gets its own.
+    """
+
+    def __init__(self, size, *handlers):
+        logging.Handler.__init__(self)
+        self.size = size
+        self.handlers = handlers
+        self.queue = None
+        self._pid = None
+
+    def _start(self):
+        self.queue = Queue.Queue(self.size)
+        QueueListener(self.queue, *self.handlers).start()
+        self._pid = os.getpid()
+
+    def emit(self, record):
+        # handle() holds the handler's lock, so only one listener is started
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            self.queue.put_nowait(record)
+        except Exception:
+            dropped_records.inc()
+
+
+class QueueListener(object):
+    """Passes the records from a queue on to handlers in a daemon thread."""
+
+    def __init__(self, queue, *handlers):
+        self.queue = queue
+        self.handlers = handlers
+
+    def handle(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def _run(self):
+        while True:
+            self.handle(self.queue.get())
+
+    def start(self):
+        thread = threading.Thread(target=self._run, name='logging')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+def configured_loggers():
+    """Return the root logger and all loggers with handlers of their own."""
+    loggers = [logging.getLogger()]
+    loggers.extend(logger for logger in logging.Logger.manager.loggerDict.values()
+                       if isinstance(logger, logging.Logger) and logger.handlers)
+    return loggers
+
+
+def queue_handlers(loggers, size):
+    """Replace the handlers of loggers by QueueHandlers with queues of
+    the given size, each passing the records on to the handler it
+    replaces."""
+    queued = {}
+    for logger in loggers:
+        for handler in logger.handlers[:]:
+            if isinstance(handler, QueueHandler):
+                continue
+            if handler not in queued:
+                queued[handler] = QueueHandler(size, handler)
+                queued[handler].setLevel(handler.level)
+            logger.removeHandler(handler)
+            logger.addHandler(queued[handler])
+
+
+def initialize_logging(config):
+    """Set up logging from LOGGING_CONFIG, a logging.config file.
+
+    LOGGING_LEVELS maps logger names to levels, e.g.
+    {'upay.server.token_authority': 'DEBUG'}. With
+    LOGGING_DEBUG_SAMPLE_RATE only that fraction of the debug records is
+    written. With LOGGING_QUEUE_SIZE the handlers are run in background
+    threads, and records which do not fit into their queues are dropped.
+    """
+    if 'LOGGING_CONFIG' in config:
+        logging.config.fileConfig(config['LOGGING_CONFIG'])
+
+    for name, level in config.get('LOGGING_LEVELS', {}).items():
+        logging.getLogger(name).setLevel(level)
+
+    loggers = configured_loggers()
+    if config.get('LOGGING_QUEUE_SIZE'):
+        queue_handlers(loggers, config['LOGGING_QUEUE_SIZE'])
+
+    if config.get('LOGGING_DEBUG_SAMPLE_RATE') is not None:
+        sample = SamplingFilter(config['LOGGING_DEBUG_SAMPLE_RATE'])
+        for handler in set(handler for logger in loggers for handler in logger.handlers):
+            if not any(isinstance(f, SamplingFilter) for f in handler.filters):
+                handler.addFilter(sample)
@@ -0,0 +1,188 @@
+"""Counters and histograms exported in the Prometheus text format.
+
+Recording a value takes a lock and, for histograms, a bisect over the
+bucket bounds, so instrumentation can stay enabled in production.
+"""
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from timeit import default_timer as clock
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = zip(names, values) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                                for name, value in pairs)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Counter(object):
+    type = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, **kwargs):
+        amount = kwargs.get('amount', 1)
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def samples(self):
+        with self._lock:
+            values = self._values.items()
+        return [(self.name, _format_labels(self.labels, labels), value)
+                    for labels, value in sorted(values)]
+
+
+class Gauge(object):
+    """A value read from a function whenever the metrics are exported."""
+    type = 'gauge'
+
+    def __init__(self, name, documentation, function):
+        self.name = name
+        self.documentation = documentation
+        self._function = function
+
+    def samples(self):
+        value = self._function()
+        if value is None:
+            return []
+        return [(self.name, '', value)]
+
+
+class FunctionCounter(Gauge):
+    """A counter read from a function whenever the metrics are exported,
+    for counts kept elsewhere."""
+    type = 'counter'
+
+
+class Histogram(object):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * len(self.buckets), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        start = clock()
+        try:
+            yield
+        finally:
+            self.observe(clock() - start, *labels)
+
+    def samples(self):
+        with self._lock:
+            values = [(labels, list(counts), total) for labels, (counts, total) in self._values.items()]
+        samples = []
+        for labels, counts, total in sorted(values):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append((self.name + '_bucket',
+                                _format_labels(self.labels, labels, [('le', _format_value(bound))]),
+                                cumulative))
+            samples.append((self.name + '_sum', _format_labels(self.labels, labels), total))
+            samples.append((self.name + '_count', _format_labels(self.labels, labels), cumulative))
+        return samples
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, function):
+        return self.register(Gauge(name, documentation, function))
+
+    def function_counter(self, name, documentation, function):
+        return self.register(FunctionCounter(name, documentation, function))
+
+    def histogram(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def render(self):
+        lines = []
+        for metric in list(self._metrics):
+            lines.append('# HELP %s %s' % (metric.name, metric.documentation))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                lines.append('%s%s %s' % (name, labels, _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+requests = registry.counter('upay_requests_total',
+    'Number of API requests', ['endpoint', 'status'])
+errors = registry.counter('upay_errors_total',
+    'Number of failed API requests by error type', ['endpoint', 'type'])
+request_duration = registry.histogram('upay_request_duration_seconds',
+    'Duration of API requests', ['endpoint'])
+stage_duration = registry.histogram('upay_stage_duration_seconds',
+    'Duration of the stages of API requests', ['stage'])
+method_duration = registry.histogram('upay_token_authority_duration_seconds',
+    'Duration of TokenAuthority methods', ['method'])
+idempotent_replays = registry.counter('upay_idempotent_replays_total',
+    'Number of requests answered with the stored result of an earlier one')
+transaction_conflicts = registry.counter('upay_transaction_conflicts_total',
+    'Transactions aborted by serialization failures or deadlocks', ['operation'])
+transaction_retries = registry.counter('upay_transaction_retries_total',
+    'Retries of aborted transactions', ['operation'])
+transaction_retries_exhausted = registry.counter('upay_transaction_retries_exhausted_total',
+    'Transactions given up after the maximum number of retries', ['operation'])
+lock_wait = registry.histogram('upay_lock_wait_seconds',
+    'Time spent waiting for token locks or the global lock')
+
+
+def timed(f):
+    """Record the duration of a TokenAuthority method."""
+    name = f.__name__
+
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        start = clock()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            method_duration.observe(clock() - start, name)
+    return decorated
@@ -0,0 +1,54 @@
+"""Checks of /transform and /create requests which need no database.
+
+They run before a connection is taken from the pool, so requests which
+are bound to fail do not cost a database round trip.
+"""
+import time
+from datetime import datetime, timedelta
+
+from jsonschema import ValidationError
+
+from . import metrics
+from .token_authority import TOKEN_MAX_AGE
+
+rejected = metrics.registry.counter('upay_prevalidation_rejected_total',
+    'Requests rejected before connecting to the database', ['endpoint', 'reason'])
+
+
+class PrevalidationError(ValidationError):
+    def __init__(self, reason, message):
+        ValidationError.__init__(self, message)
+        self.reason = reason
+
+
+def check_transform(input_tokens, output_tokens, config):
+    """Raise PrevalidationError if the transform can not succeed.
+
+    Output tokens older than TOKEN_MAX_AGE seconds are only rejected with
+    ALLOW_TOKEN_RESTORE = False, as they may be voided tokens which are
+    being restored.
+    """
+    if sum(t.value for t in input_tokens) != sum(t.value for t in output_tokens):
+        raise PrevalidationError('value_mismatch', 'Split value does not match token value')
+
+    hashes = set(t.hash_string for t in input_tokens + output_tokens)
+    if len(hashes) != len(input_tokens) + len(output_tokens):
+        raise PrevalidationError('duplicate_hash', 'Tokens must have distinct hashes')
+
+    # Do not use utcnow() as time.time() gets mocked by the unit tests
+    now = datetime.utcfromtimestamp(time.time())
+    max_age = timedelta(seconds=TOKEN_MAX_AGE)
+    if any(t.created - now >= max_age for t in output_tokens):
+        raise PrevalidationError('created_in_future', 'Token is from the future')
+    if not config.get('ALLOW_TOKEN_RESTORE', True) and \
+            any(now - t.created >= max_age for t in output_tokens):
+        raise PrevalidationError('too_old', 'Token is too old')
+
+
+def check_create(values, config):
+    """Raise PrevalidationError if more than CREATE_MAX_TOKENS (default
+    500) tokens are requested."""
+    max_tokens = config.get('CREATE_MAX_TOKENS', 500)
+    if len(values) > max_tokens:
+        raise PrevalidationError('too_many_tokens',
+            'At most %d tokens can be created per request' % max_tokens)
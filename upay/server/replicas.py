@@ -0,0 +1,87 @@
+import logging
+import threading
+from timeit import default_timer as clock
+
+from sqlalchemy import text
+
+# Replication lag of a PostgreSQL standby in seconds. A standby which has
+# replayed everything it received counts as up to date, even if the
+# primary has not written anything for a while.
+_POSTGRESQL_LAG = text(
+    "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END")
+
+
+class Replica(object):
+    def __init__(self, engine):
+        self.engine = engine
+        self.healthy = False
+        self.lag = None
+        self.checked = None
+
+    def check(self):
+        """Update the health and replication lag of the replica."""
+        try:
+            with self.engine.connect() as connection:
+                if self.engine.dialect.name == 'postgresql':
+                    lag = float(connection.execute(_POSTGRESQL_LAG).scalar() or 0)
+                else:
+                    connection.execute(text("SELECT 1"))
+                    lag = 0.0
+            healthy = True
+        except Exception:
+            logging.getLogger(__name__).warning("Replica %s is down", self.engine.url,
+                                                exc_info=True)
+            healthy = False
+            lag = None
+        self.healthy, self.lag, self.checked = healthy, lag, clock()
+
+
+class ReplicaSet(object):
+    """Picks a healthy read replica which is not lagging behind.
+
+    The replicas are probed by check(), which the health monitor calls
+    in the background, so choosing one never waits for a database. A
+    replica is only used while its last check succeeded, is at most
+    max_age seconds old and found it lagging at most max_lag seconds
+    behind.
+    """
+
+    def __init__(self, engines, max_lag=5, max_age=15):
+        self.replicas = [Replica(engine) for engine in engines]
+        self.max_lag = max_lag
+        self.max_age = max_age
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def _usable(self, replica, now):
+        # Read without a lock; a result mixing two checks does no harm
+        healthy, lag, checked = replica.healthy, replica.lag, replica.checked
+        return healthy and checked is not None and lag <= self.max_lag \
+            and now - checked <= self.max_age
+
+    def check(self):
+        """Check all replicas."""
+        for replica in self.replicas:
+            replica.check()
+
+    def choose(self):
+        """Return the engine of a usable replica, or None."""
+        now = clock()
+        usable = [replica for replica in self.replicas if self._usable(replica, now)]
+        if not usable:
+            return None
+        with self._lock:
+            self._next = (self._next + 1) % len(usable)
+            return usable[self._next].engine
+
+    def dispose(self):
+        for replica in self.replicas:
+            replica.engine.dispose()
+
+    def stats(self):
+        return {
+            'total': len(self.replicas),
+            'healthy': len([replica for replica in self.replicas
+                                if self._usable(replica, clock())]),
+        }
@@ -1,4 +1,6 @@
-from jsonschema import validate
+import json
+from jsonschema import ValidationError
+from jsonschema.validators import validator_for
 from upay.common import Token
 
 _value_schema = {
@@ -48,12 +50,58 @@ _create_schema = {
         "values" : _values_schema,
      }
 }
-def validate_validate(json):
-    validate(json, _validate_schema)
 
-def validate_transform(json):
-    validate(json, _transform_schema)
 
-def validate_create(json):
-    validate(json, _create_schema)
+def _unique_properties(schema):
+    return [name for name, subschema in schema['properties'].items()
+                if subschema.get('uniqueItems')]
 
+
+def _without_unique_items(schema, names):
+    """Return a copy of schema without the uniqueItems checks of the
+    array properties names.
+
+    jsonschema compares all pairs of items, which is quadratic in the
+    number of tokens. _check_unique() does the same check in linear time.
+    """
+    properties = dict(schema['properties'])
+    for name in names:
+        properties[name] = dict((key, value) for key, value in properties[name].items()
+                                    if key != 'uniqueItems')
+    return dict(schema, properties=properties)
+
+
+def _check_unique(items):
+    seen = set()
+    for item in items:
+        key = json.dumps(item, sort_keys=True)
+        if key in seen:
+            raise ValidationError("%r has non-unique elements" % (items,), validator='uniqueItems')
+        seen.add(key)
+
+
+def _validator(schema):
+    """Compile schema once and return a function validating against it."""
+    cls = validator_for(schema)
+    cls.check_schema(schema)
+    unique_properties = _unique_properties(schema)
+    validator = cls(_without_unique_items(schema, unique_properties))
+
+    def validate(instance):
+        validator.validate(instance)
+        for name in unique_properties:
+            if name in instance:
+                _check_unique(instance[name])
+    return validate
+
+
+_token_validator = validator_for(Token.TOKEN_SCHEMA)(Token.TOKEN_SCHEMA)
+
+
+def validate_token(json):
+    _token_validator.validate(json)
+
+
+validate_validate = _validator(_validate_schema)
+validate_transform = _validator(_transform_schema)
+validate_create = _validator(_create_schema)
@@ -0,0 +1,71 @@
+"""Decoding of request bodies and encoding of token lists.
+
+JSON is parsed with ujson if it is installed. Requests sent with
+Content-Type: application/msgpack are decoded with msgpack, if it is
+installed, and answered in msgpack.
+"""
+import json
+from json.encoder import encode_basestring_ascii
+
+from flask import Response
+from jsonschema import ValidationError
+
+try:
+    import ujson as _json
+except ImportError:
+    _json = json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+_MSGPACK_TYPES = (MSGPACK, 'application/x-msgpack')
+
+
+class UnsupportedMediaTypeError(Exception):
+    code = 415
+
+
+def loads(data):
+    return _json.loads(data)
+
+
+def request_format(request):
+    """Return the format of the request body, JSON or MSGPACK."""
+    if request.mimetype in _MSGPACK_TYPES:
+        if msgpack is None:
+            raise UnsupportedMediaTypeError("msgpack is not installed")
+        return MSGPACK
+    return JSON
+
+
+def decode_request(request, wire_format):
+    """Return the decoded body of request. Like request.json, a body
+    which is not declared as JSON is returned as None. Raises
+    ValidationError if the body can not be decoded."""
+    try:
+        if wire_format == MSGPACK:
+            return msgpack.unpackb(request.get_data(), raw=False)
+        if request.mimetype != JSON:
+            return None
+        return loads(request.get_data())
+    except Exception as ex:
+        raise ValidationError("Can not decode the request: %s" % ex)
+
+
+def strings_response(key, strings, wire_format):
+    """Return a response holding {key: [string, ...]}.
+
+    The JSON is written directly instead of building a dict for
+    jsonify(), and without its indentation.
+    """
+    if wire_format == MSGPACK:
+        # Python 2 str objects have to be packed as strings, not as binary
+        return Response(msgpack.packb({key: list(strings)}, use_bin_type=False),
+                        mimetype=MSGPACK)
+    body = '{%s:[%s]}' % (encode_basestring_ascii(key),
+                          ','.join(encode_basestring_ascii(s) for s in strings))
+    return Response(body, mimetype=JSON)
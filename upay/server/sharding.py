@@ -0,0 +1,269 @@
+import copy
+import logging
+from datetime import datetime, timedelta
+
+from sqlalchemy import Table, Column, DateTime, String, MetaData, select
+
+from upay.common import Token
+
+from .token_authority import TokenAuthority
+
+# The coordinator log of two phase commits, kept in the first shard. The
+# xids of the prepared shard transactions are recorded here before any
+# of them is committed, so recover() knows which ones to commit.
+_metadata = MetaData()
+_decisions = Table('twophase_decisions', _metadata,
+    Column('xid', String(200), primary_key=True),
+    Column('decided', DateTime, nullable=False))
+
+
+class ShardedTokenAuthority(object):
+    """A TokenAuthority spreading the tokens over several databases.
+
+    Each token lives in the database of DATABASE_SHARDS selected by the
+    first SHARD_PREFIX_LENGTH (default 4) hex digits of its hash. Changing
+    the list of shards requires moving the existing tokens.
+
+    Transforms touching several shards are committed with a two phase
+    commit, which on PostgreSQL needs max_prepared_transactions > 0. With
+    DATABASE_SHARDS_TWO_PHASE = False the shards are committed one after
+    the other, which is not atomic and only meant for testing.
+
+    Transactions left prepared by a crash are resolved by recover() when
+    a ShardedTokenAuthority is created.
+    """
+
+    def __init__(self, config):
+        self._logger = logging.getLogger(__name__)
+        self.config = config
+        self._prefix_length = config.get('SHARD_PREFIX_LENGTH', 4)
+        self._two_phase = config.get('DATABASE_SHARDS_TWO_PHASE', True)
+        self._shards = [TokenAuthority(dict(config, DATABASE_URL=url))
+                            for url in config['DATABASE_SHARDS']]
+        self._connected = False
+        if self._two_phase and len(self._shards) > 1:
+            try:
+                self.recover()
+            except Exception:
+                self._logger.error("Recovering prepared transactions failed", exc_info=True)
+
+    def shard_index(self, token):
+        return int(token.hash_string[:self._prefix_length], 16) % len(self._shards)
+
+    def _group(self, tokens):
+        groups = {}
+        for token in tokens:
+            groups.setdefault(self.shard_index(token), []).append(token)
+        return groups
+
+    def _shard(self, index):
+        shard = self._shards[index]
+        if self._connected and shard._connection is None:
+            shard.connect(self._two_phase)
+        return shard
+
+    def _connected_shards(self):
+        return [shard for shard in self._shards if shard._connection is not None]
+
+    def session(self):
+        session = copy.copy(self)
+        session._shards = [shard.session() for shard in self._shards]
+        session._connected = False
+        return session
+
+    def read_session(self):
+        # Read replicas are not supported per shard
+        return self.session()
+
+    def replica_stats(self):
+        return None
+
+    def check_health(self):
+        for shard in self._shards:
+            shard.check_health()
+
+    def pool_stats(self):
+        stats = [shard.pool_stats() for shard in self._shards]
+        if None in stats:
+            return None
+        return dict((key, sum(s[key] for s in stats)) for key in stats[0])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._connected:
+            self.disconnect()
+
+    def connect(self):
+        # The shards connect when they are used first
+        self._connected = True
+
+    def disconnect(self):
+        for shard in self._connected_shards():
+            shard.disconnect()
+        self._connected = False
+
+    def commit(self):
+        shards = self._connected_shards()
+        if not self._two_phase or len(shards) < 2:
+            for shard in shards:
+                shard.commit()
+            return
+
+        xids = [shard._transaction.xid for shard in shards]
+        try:
+            for shard in shards:
+                shard.prepare()
+            self._record_decision(xids)
+        except Exception:
+            self._logger.warning("Prepare failed, rolling back all shards", exc_info=True)
+            self.rollback()
+            raise
+        # From here on the transaction counts as committed. If this
+        # process dies, recover() commits the remaining shards.
+        for shard in shards:
+            shard.commit()
+        try:
+            self._forget_decision(xids)
+        except Exception:
+            self._logger.warning("Removing a commit decision failed", exc_info=True)
+
+    def _record_decision(self, xids):
+        now = datetime.utcnow()
+        with self._shards[0]._engine.begin() as connection:
+            connection.execute(_decisions.insert(), [{'xid': xid, 'decided': now} for xid in xids])
+
+    def _forget_decision(self, xids):
+        with self._shards[0]._engine.begin() as connection:
+            connection.execute(_decisions.delete().where(_decisions.c.xid.in_(xids)))
+
+    def recover(self):
+        """Resolve two phase transactions left prepared, e.g. by a crash
+        between prepare() and commit().
+
+        Transactions prepared more than DATABASE_SHARDS_RECOVERY_AGE
+        (default 300) seconds ago are committed if their xid is in the
+        coordinator log and rolled back otherwise. The age keeps this from
+        interfering with commits of other servers which are in progress.
+        """
+        min_age = self.config.get('DATABASE_SHARDS_RECOVERY_AGE', 300)
+        with self._shards[0]._engine.begin() as connection:
+            decided = dict((row.xid, row.decided) for row in
+                               connection.execute(select([_decisions.c.xid, _decisions.c.decided])))
+
+        for shard in self._shards:
+            for xid in shard.prepared_transactions(min_age):
+                commit = xid in decided
+                self._logger.warning("%s prepared transaction %s",
+                                     "Committing" if commit else "Rolling back", xid)
+                try:
+                    shard.finish_prepared(xid, commit)
+                except Exception:
+                    # Another server may have resolved it already
+                    self._logger.warning("Resolving %s failed", xid, exc_info=True)
+
+        # A decision is only forgotten once no shard holds its transaction
+        # any more. Otherwise a later run would roll back shards whose
+        # siblings are committed already.
+        pending = set()
+        for shard in self._shards:
+            pending.update(shard.prepared_transactions(0))
+        cutoff = datetime.utcnow() - timedelta(seconds=min_age)
+        resolved = [xid for xid, time in decided.items() if time < cutoff and xid not in pending]
+        if resolved:
+            self._forget_decision(resolved)
+
+    def rollback(self):
+        for shard in self._connected_shards():
+            shard.rollback()
+
+    def bootstrap_db(self):
+        for shard in self._shards:
+            shard.bootstrap_db()
+        _metadata.drop_all(self._shards[0]._engine)
+        _metadata.create_all(self._shards[0]._engine)
+
+    def migrate_db(self, batch_size=10000):
+        for shard in self._shards:
+            shard.migrate_db(batch_size)
+        _metadata.create_all(self._shards[0]._engine)
+
+    def compact(self, retention, batch_size=1000):
+        return sum(shard.compact(retention, batch_size) for shard in self._shards)
+
+    def enable_token_filter(self, capacity, error_rate=0.001, margin=600):
+        for shard in self._shards:
+            shard.enable_token_filter(capacity // len(self._shards) + 1, error_rate, margin)
+
+    def token_filter_stats(self):
+        stats = [shard.token_filter_stats() for shard in self._shards]
+        if None in stats:
+            return None
+        total = dict((key, sum(s[key] for s in stats)) for key in
+                        ('size_bytes', 'capacity', 'tokens', 'checks', 'rejected'))
+        total['error_rate'] = stats[0]['error_rate']
+        return total
+
+    def validate_token(self, token):
+        self._shard(self.shard_index(token)).validate_token(token)
+
+    def validate_tokens(self, tokens):
+        valid = set()
+        for index, shard_tokens in self._group(tokens).items():
+            valid.update(id(token) for token in self._shard(index).validate_tokens(shard_tokens))
+        return [token for token in tokens if id(token) in valid]
+
+    def create_tokens(self, tokens):
+        for index, shard_tokens in self._group(tokens).items():
+            self._shard(index).create_tokens(shard_tokens)
+
+    def mint_tokens(self, tokens):
+        for index, shard_tokens in self._group(tokens).items():
+            self._shard(index).mint_tokens(shard_tokens)
+
+    def void_tokens(self, tokens):
+        for index, shard_tokens in self._group(tokens).items():
+            self._shard(index).void_tokens(shard_tokens)
+
+    # Idempotency keys are kept in the first shard, whose transaction is
+    # committed along with the others.
+
+    def find_idempotent_result(self, key):
+        return self._shard(0).find_idempotent_result(key)
+
+    def store_idempotent_result(self, key, fingerprint, result, ttl):
+        self._shard(0).store_idempotent_result(key, fingerprint, result, ttl)
+
+    def create_token(self, token):
+        self.create_tokens([token])
+
+    def void_token(self, token):
+        self.void_tokens([token])
+
+    def transform_tokens(self, input_tokens, output_tokens):
+        total_input_value = sum([t.value for t in input_tokens])
+        total_output_value = sum([t.value for t in output_tokens])
+
+        if total_input_value != total_output_value:
+            raise ValueError("Split value does not match token value")
+
+        self.void_tokens(input_tokens)
+        self.create_tokens(output_tokens)
+        return output_tokens
+
+    def split_token(self, token, split_tokens):
+        return self.transform_tokens([token], split_tokens)
+
+    def merge_tokens(self, tokens):
+        token = Token(sum([t.value for t in tokens]))
+        self.transform_tokens(tokens, [token])
+        return token
+
+
+def create_token_authority(config):
+    """Return a ShardedTokenAuthority if DATABASE_SHARDS is configured,
+    a TokenAuthority otherwise."""
+    if config.get('DATABASE_SHARDS'):
+        return ShardedTokenAuthority(config)
+    return TokenAuthority(config)
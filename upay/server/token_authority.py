@@ -1,12 +1,31 @@
+import os
+import json
+import binascii
+import copy
 import logging
 import sqlalchemy
-from sqlalchemy import Table, Column, DateTime, String, MetaData, select
+from sqlalchemy import Table, Column, Index, DateTime, String, Text, LargeBinary, MetaData, \
+                       TypeDecorator, select, func, literal, text, and_, or_
 
 import time
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from upay.common import Token
 
+from .bloom import TokenFilter
+from .metrics import timed
+from .replicas import ReplicaSet
+
+
+def _chunks(items, size):
+    for i in xrange(0, len(items), size):
+        yield items[i:i + size]
+
+
+# Tokens created by clients have to be younger than this many seconds,
+# unless they are restored.
+TOKEN_MAX_AGE = 60
+
 
 class NoValidTokenFoundError(Exception):
     pass
@@ -16,34 +35,274 @@ class TimeoutError(Exception):
     pass
 
 
+class HexBinary(TypeDecorator):
+    """Stores a hex string as raw bytes, taking half the space."""
+    impl = LargeBinary
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return binascii.unhexlify(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return binascii.hexlify(value)
+
+
+_metadata = MetaData()
+_tokens = Table('tokens', _metadata,
+    Column('hash', HexBinary(Token.HASH_STRING_LENGTH // 2), primary_key=True),
+    Column('created', DateTime),
+    Column('used', DateTime)
+)
+# Only unused tokens can be validated or voided. Keeping them in a
+# separate, small index keeps these lookups away from the voided rows.
+Index('ix_tokens_unused', _tokens.c.hash, _tokens.c.created,
+      postgresql_where = _tokens.c.used == None,
+      sqlite_where = _tokens.c.used == None)
+Index('ix_tokens_used', _tokens.c.used,
+      postgresql_where = _tokens.c.used != None,
+      sqlite_where = _tokens.c.used != None)
+
+# Tokens voided longer than ARCHIVE_RETENTION ago, moved here by compact().
+# Rows are only ever appended, a token restored from the archive keeps its
+# old row.
+_archive = Table('tokens_archive', _metadata,
+    Column('hash', HexBinary(Token.HASH_STRING_LENGTH // 2), index=True),
+    Column('created', DateTime),
+    Column('used', DateTime),
+    Column('archived', DateTime)
+)
+
+# Results of requests by their Idempotency-Key. They are written in the
+# transaction of the request, so a retry reaching any server process gets
+# the result of the first request, even after a crash.
+_idempotency_keys = Table('idempotency_keys', _metadata,
+    Column('key', String(255), primary_key=True),
+    Column('fingerprint', String(64), nullable=False),
+    Column('result', Text, nullable=False),
+    Column('expires', DateTime, nullable=False, index=True)
+)
+
+# The layout before the hash was stored as binary. Only used by migrate_db().
+_legacy_tokens = Table('tokens', MetaData(),
+    Column('hash', String(Token.HASH_STRING_LENGTH), primary_key=True),
+    Column('created', DateTime),
+    Column('used', DateTime)
+)
+
+# Maps configuration keys to the keyword arguments of create_engine().
+# Only the keys present in the configuration are passed on, as not every
+# pool class accepts every argument (e.g. SQLite in-memory databases).
+_POOL_OPTIONS = {
+    'DATABASE_POOL_SIZE': 'pool_size',
+    'DATABASE_MAX_OVERFLOW': 'max_overflow',
+    'DATABASE_POOL_TIMEOUT': 'pool_timeout',
+    'DATABASE_POOL_RECYCLE': 'pool_recycle',
+    'DATABASE_POOL_PRE_PING': 'pool_pre_ping',
+}
+
+
+def create_engine(config, url=None, isolation_level='SERIALIZABLE'):
+    options = dict((argument, config[key]) for key, argument in _POOL_OPTIONS.items()
+                    if key in config)
+    return sqlalchemy.create_engine(url or config['DATABASE_URL'],
+                                    echo = False,
+                                    isolation_level = isolation_level,
+                                    **options)
+
+
 class TokenAuthority(object):
+    """Access to the tokens database.
+
+    A TokenAuthority owns the engine and its connection pool. It is meant
+    to be long lived: each unit of work should get its own connection
+    through session(), which shares the pool with its parent.
+    """
+
     def __init__(self, config):
         self._logger = logging.getLogger(__name__)
         self.config = config
+        self._connection = None
+        self._transaction = None
+        self._two_phase = False
+        self._token_filter = None
+        self._pid = os.getpid()
         try:
-            isolation_level = 'SERIALIZABLE'
-            self._engine = sqlalchemy.create_engine(config['DATABASE_URL'],
-                                                    echo = False,
-                                                    isolation_level = isolation_level)
+            self._engine = create_engine(config)
             self.connect()
             self.disconnect()
         except Exception as e:
             self._logger.warning("Can not connect to the database", exc_info=True)
             raise RuntimeError(e)
+        self._primary_engine = self._engine
+        self._replicas = None
+        if config.get('DATABASE_REPLICA_URLS'):
+            # Hot standbys do not support SERIALIZABLE transactions
+            isolation_level = config.get('DATABASE_REPLICA_ISOLATION_LEVEL', 'REPEATABLE READ')
+            self._replicas = ReplicaSet(
+                [create_engine(config, url, isolation_level) for url in config['DATABASE_REPLICA_URLS']],
+                config.get('DATABASE_REPLICA_MAX_LAG', 5),
+                config.get('HEALTH_CHECK_MAX_AGE', 3 * config.get('HEALTH_CHECK_INTERVAL', 5)))
         self._init_metadata()
 
     def _init_metadata(self):
-        self._metadata = MetaData()
-        self._tokens = Table('tokens', self._metadata,
-            Column('hash', String(Token.HASH_STRING_LENGTH), primary_key=True),
-            Column('created', DateTime),
-            Column('used', DateTime)
-        )
-
-    def connect(self):
+        self._metadata = _metadata
+        self._tokens = _tokens
+        self._archive = _archive
+        self._idempotency_keys = _idempotency_keys
+
+    def _check_fork(self):
+        """Give this process its own connection pools after a fork.
+
+        Connections inherited from the parent process must not be shared
+        with it. Everything taking connections from the engines without a
+        session() has to call this first.
+        """
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._primary_engine.dispose()
+            if self._replicas is not None:
+                self._replicas.dispose()
+
+    def session(self):
+        """Return a new, not yet connected TokenAuthority sharing this
+        authority's engine and connection pool."""
+        self._check_fork()
+        session = copy.copy(self)
+        session._connection = None
+        session._transaction = None
+        return session
+
+    def read_session(self):
+        """Return a session for work which does not write to the
+        database.
+
+        It is connected to a read replica from DATABASE_REPLICA_URLS if
+        the last check_health() found one healthy and lagging at most
+        DATABASE_REPLICA_MAX_LAG seconds behind, and to the primary
+        database otherwise. A lagging replica may still report a token
+        as valid which was voided moments ago; only the primary can tell
+        whether a token can be spent.
+        """
+        session = self.session()
+        if self._replicas is not None:
+            session._engine = self._replicas.choose() or self._primary_engine
+        return session
+
+    def prepared_transactions(self, min_age):
+        """Return the xids of two phase transactions prepared by
+        SQLAlchemy more than min_age seconds ago and neither committed nor
+        rolled back since. Only PostgreSQL is supported; other databases
+        return none."""
+        if self._engine.dialect.name != 'postgresql':
+            return []
+        self._check_fork()
+        with self._engine.connect() as connection:
+            rows = connection.execute(text(
+                "SELECT gid FROM pg_prepared_xacts WHERE database = current_database() "
+                "AND prepared < now() - :age * interval '1 second'"), age=min_age)
+            return [row.gid for row in rows if row.gid.startswith('_sa_')]
+
+    def finish_prepared(self, xid, commit):
+        """Commit or roll back the prepared transaction xid."""
+        self._check_fork()
+        with self._engine.connect() as connection:
+            if commit:
+                connection.commit_prepared(xid, recover=True)
+            else:
+                connection.rollback_prepared(xid, recover=True)
+
+    def check_health(self):
+        """Check that the database answers a trivial query, without a
+        transaction. The read replicas are checked as well, but only
+        the primary database decides about the health."""
+        self._check_fork()
+        if self._replicas is not None:
+            self._replicas.check()
+        with self._primary_engine.connect() as connection:
+            connection.execute(select([literal(1)]))
+
+    def pool_stats(self):
+        """Return the connection pool usage, or None if the pool does not
+        keep track of it (e.g. SQLite in-memory databases)."""
+        pool = self._primary_engine.pool
+        if not hasattr(pool, 'checkedout'):
+            return None
+        return {
+            'size': pool.size(),
+            'checked_out': pool.checkedout(),
+            'overflow': max(pool.overflow(), 0),
+            'max_overflow': self.config.get('DATABASE_MAX_OVERFLOW', 10),
+        }
+
+    def replica_stats(self):
+        if self._replicas is None:
+            return None
+        return self._replicas.stats()
+
+    def enable_token_filter(self, capacity, error_rate=0.001, margin=600):
+        """Build a Bloom filter of all tokens in the database, used,
+        unused and archived, which lets validation reject tokens which
+        never existed without a database query.
+
+        Used tokens are included as another process may restore them.
+        Tokens created up to margin seconds, at least TOKEN_MAX_AGE,
+        before the filter was built can still be inserted by other
+        processes and always pass. Tokens committed later than that after
+        their creation are rejected. Sessions created afterwards share the
+        filter.
+        """
+        margin = max(margin, TOKEN_MAX_AGE)
+        built = datetime.utcfromtimestamp(time.time()) - timedelta(seconds=margin)
+        token_filter = TokenFilter(capacity, error_rate, built)
+        self._check_fork()
+        with self._engine.connect() as connection:
+            connection = connection.execution_options(stream_results=True)
+            for table in (self._tokens, self._archive):
+                for row in connection.execute(select([table.c.hash])):
+                    token_filter.add(row.hash)
+        self._token_filter = token_filter
+        self._logger.info("Token filter built: %s", token_filter.stats())
+
+    def token_filter_stats(self):
+        if self._token_filter is None:
+            return None
+        return self._token_filter.stats()
+
+    def _filter_tokens(self, tokens):
+        if self._token_filter is None:
+            return tokens
+        return [token for token in tokens if self._token_filter.might_be_valid(token)]
+
+    def _add_to_filter(self, tokens):
+        if self._token_filter is not None:
+            map(self._token_filter.add, [token.hash_string for token in tokens])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._connection is not None:
+            self.disconnect()
+
+    @timed
+    def connect(self, two_phase=False):
+        """Connect to the database and begin a transaction.
+
+        With two_phase, transactions are two phase transactions which can
+        be prepare()d before they are committed.
+        """
         self._logger.debug("connect()")
+        self._two_phase = two_phase
         self._connection = self._engine.connect()
-        self._transaction = self._connection.begin()
+        self._transaction = self._begin()
+
+    def _begin(self):
+        if self._two_phase:
+            return self._connection.begin_twophase()
+        return self._connection.begin()
 
     def disconnect(self):
         self._logger.debug("disconnect()")
@@ -52,15 +311,23 @@ class TokenAuthority(object):
         self._connection.close()
         self._connection = None
 
+    @timed
+    def prepare(self):
+        """First phase of committing a two phase transaction."""
+        self._logger.debug("prepare()")
+        self._transaction.prepare()
+
+    @timed
     def commit(self):
         self._logger.debug("commit()")
         self._transaction.commit()
-        self._transaction = self._connection.begin()
+        self._transaction = self._begin()
 
+    @timed
     def rollback(self):
         self._logger.debug("rollback()")
         self._transaction.rollback()
-        self._transaction = self._connection.begin()
+        self._transaction = self._begin()
 
     def bootstrap_db(self):
         if not self.config['DATABASE_ALLOW_BOOTSTRAP']:
@@ -70,20 +337,149 @@ class TokenAuthority(object):
         self._metadata.drop_all(self._engine)
         self._metadata.create_all(self._engine)
 
-    def split_token(self, token, split_tokens):
-        self._logger.debug("split()")
+    def migrate_db(self, batch_size=10000):
+        """Migrate a tokens table storing the hash as string to the
+        current layout.
 
-        total_split_value = sum([t.value for t in split_tokens])
+        Rows are copied into a new table in batches, each in its own
+        transaction. An interrupted migration continues where it stopped
+        when run again. The server must not run during the migration.
+        Tables and indexes missing in the database are created.
+        """
+        inspector = sqlalchemy.inspect(self._engine)
+        if 'tokens_new' in inspector.get_table_names():
+            self._migrate_tokens(batch_size)
+        else:
+            hash_type = [column['type'] for column in inspector.get_columns('tokens')
+                            if column['name'] == 'hash'][0]
+            if isinstance(hash_type, String):
+                self._tokens.tometadata(MetaData(), name='tokens_new').create(self._engine)
+                self._migrate_tokens(batch_size)
 
-        if total_split_value != token.value:
-            raise ValueError("Split value does not match token value")
+        # Tables and indexes added without changing existing ones
+        self._metadata.create_all(self._engine)
+        indexes = [index['name'] for index in sqlalchemy.inspect(self._engine).get_indexes('tokens')]
+        for index in self._tokens.indexes:
+            if index.name not in indexes:
+                index.create(self._engine)
 
+    def _migrate_tokens(self, batch_size):
+        new_tokens = self._tokens.tometadata(MetaData(), name='tokens_new')
 
-        with self._connection.begin() as trans:
-            self.validate_token(token)
-            self.void_token(token)
-            map(self.create_token, split_tokens)
-            return split_tokens
+        with self._engine.begin() as connection:
+            last_hash = connection.execute(select([func.max(new_tokens.c.hash)])).scalar()
+
+        copied = 0
+        while True:
+            with self._engine.begin() as connection:
+                statement = select([_legacy_tokens]).order_by(_legacy_tokens.c.hash).limit(batch_size)
+                if last_hash is not None:
+                    statement = statement.where(_legacy_tokens.c.hash > last_hash)
+                rows = connection.execute(statement).fetchall()
+                if not rows:
+                    break
+                connection.execute(new_tokens.insert(),
+                    [{'hash': row.hash, 'created': row.created, 'used': row.used} for row in rows])
+            last_hash = rows[-1].hash
+            copied += len(rows)
+            self._logger.info("Migrated %d tokens", copied)
+
+        self._swap_tokens_table()
+
+    def _swap_tokens_table(self):
+        """Replace the tokens table by tokens_new in one transaction."""
+        statements = ["DROP TABLE tokens", "ALTER TABLE tokens_new RENAME TO tokens"]
+        if self._engine.dialect.name != 'sqlite':
+            with self._engine.begin() as connection:
+                for statement in statements:
+                    connection.execute(statement)
+            return
+
+        # pysqlite commits before every DDL statement, so the transaction
+        # has to be managed by hand, bypassing it.
+        connection = self._engine.raw_connection()
+        dbapi_connection = connection.connection
+        isolation_level = dbapi_connection.isolation_level
+        try:
+            dbapi_connection.isolation_level = None
+            cursor = dbapi_connection.cursor()
+            cursor.execute("BEGIN")
+            try:
+                for statement in statements:
+                    cursor.execute(statement)
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+            cursor.execute("COMMIT")
+        finally:
+            dbapi_connection.isolation_level = isolation_level
+            connection.close()
+
+    @timed
+    def compact(self, retention, batch_size=1000):
+        """Move tokens voided more than retention seconds ago to the
+        archive.
+
+        Works in batches of batch_size tokens, each in its own short
+        transaction. Returns the number of archived tokens. Expired
+        idempotency keys are removed as well.
+        """
+        now = datetime.utcfromtimestamp(time.time())
+        with self._engine.begin() as connection:
+            connection.execute(self._idempotency_keys.delete() \
+                                .where(self._idempotency_keys.c.expires <= now))
+
+        cutoff = datetime.utcnow() - timedelta(seconds=retention)
+        archived = 0
+        while True:
+            with self._engine.begin() as connection:
+                statement = select([self._tokens]) \
+                                .where(self._tokens.c.used < cutoff) \
+                                .limit(batch_size) \
+                                .with_for_update()
+                rows = connection.execute(statement).fetchall()
+                if not rows:
+                    break
+                now = datetime.utcnow()
+                connection.execute(self._archive.insert(),
+                    [{'hash': row.hash, 'created': row.created, 'used': row.used, 'archived': now}
+                        for row in rows])
+                res = connection.execute(self._tokens.delete() \
+                                .where(self._tokens.c.hash.in_([row.hash for row in rows])) \
+                                .where(self._tokens.c.used < cutoff))
+                if res.rowcount != len(rows):
+                    raise RuntimeError("Tokens changed during compaction")
+            archived += len(rows)
+            self._logger.info("Archived %d tokens", archived)
+        return archived
+
+    def find_idempotent_result(self, key):
+        """Return (fingerprint, result) stored for the idempotency key,
+        or None if there is none or it expired."""
+        # Do not use utcnow() as time.time() gets mocked by the unit tests
+        now = datetime.utcfromtimestamp(time.time())
+        keys = self._idempotency_keys
+        row = self._execute(select([keys.c.fingerprint, keys.c.result]) \
+                                .where(keys.c.key == key) \
+                                .where(keys.c.expires > now)).fetchone()
+        if row is None:
+            return None
+        return row.fingerprint, json.loads(row.result)
+
+    def store_idempotent_result(self, key, fingerprint, result, ttl):
+        """Store the result of a request for ttl seconds. It is committed
+        along with the changes of the request."""
+        now = datetime.utcfromtimestamp(time.time())
+        keys = self._idempotency_keys
+        # An expired entry may not have been removed yet
+        self._execute(keys.delete().where(keys.c.key == key).where(keys.c.expires <= now))
+        self._execute(keys.insert(), {'key': key, 'fingerprint': fingerprint,
+                                      'result': json.dumps(result),
+                                      'expires': now + timedelta(seconds=ttl)})
+
+    def split_token(self, token, split_tokens):
+        self._logger.debug("split()")
+        return self.transform_tokens([token], split_tokens)
 
     def merge_tokens(self, tokens):
         self._logger.debug("merge()")
@@ -91,63 +487,184 @@ class TokenAuthority(object):
         total_value = sum([token.value for token in tokens])
         token = Token(total_value)
 
+        self.transform_tokens(tokens, [token])
+        return token
+
+    @timed
+    def transform_tokens(self, input_tokens, output_tokens):
+        """Void input_tokens and create output_tokens in one step.
+
+        Needs one UPDATE for the inputs and one SELECT plus one INSERT for
+        the outputs, independent of the number of tokens. Either all
+        tokens are transformed or none.
+        """
+        self._logger.debug("transform()")
+
+        total_input_value = sum([t.value for t in input_tokens])
+        total_output_value = sum([t.value for t in output_tokens])
+
+        if total_input_value != total_output_value:
+            raise ValueError("Split value does not match token value")
+
         with self._connection.begin() as trans:
-            map(self.validate_token, tokens)
-            map(self.void_token, tokens)
-            self.create_token(token)
-            return token
+            self.void_tokens(input_tokens)
+            self.create_tokens(output_tokens)
+            return output_tokens
 
     def create_token(self, token):
-        self._logger.debug("create(%s)" % token)
+        self._logger.debug("create(%s)", token)
+        self.create_tokens([token])
+
+    @timed
+    def create_tokens(self, tokens):
+        """Create tokens, restoring the ones which have been voided before.
+
+        New tokens have to be younger than TOKEN_MAX_AGE seconds. Older
+        tokens are only looked up in the archive if they are not in the
+        tokens table.
+        """
+        self._logger.debug("create_tokens(%d tokens)", len(tokens))
+
+        with self._connection.begin() as trans:
+            voided = self._find_tokens(tokens, self._tokens.c.used != None)
+            restore_tokens = [t for t in tokens if (t.hash_string, t.created) in voided]
+            new_tokens = [t for t in tokens if (t.hash_string, t.created) not in voided]
 
-        result = self._execute(select([self._tokens]) \
-                            .where(self._tokens.c.hash == token.hash_string) \
-                            .where(self._tokens.c.created == token.created) \
-                            .where(self._tokens.c.used != None)).fetchone()
-        if result is None:
             # Do not use utcnow() as time.time() gets mocked by the unit tests
             now = datetime.utcfromtimestamp(time.time())
-            if abs((token.created - now).total_seconds()) >= 60:
-                self._logger.warning("Token %s is too old." % token)
-                raise TimeoutError("Token is too old")
+            old_tokens = [t for t in new_tokens if abs((t.created - now).total_seconds()) >= TOKEN_MAX_AGE]
+            if old_tokens:
+                # Archived tokens get inserted again as unused tokens
+                archived = self._find_tokens(old_tokens, self._archive.c.used != None, self._archive)
+                for token in old_tokens:
+                    if (token.hash_string, token.created) not in archived:
+                        self._logger.warning("Token %s is too old.", token)
+                        raise TimeoutError("Token is too old")
 
-            with self._connection.begin() as trans:
-                ins = self._tokens.insert().values(hash = token.hash_string, created = token.created)
-                self._execute(ins)
-        else:
-            with self._connection.begin() as trans:
-                statement = self._tokens.update().where(self._tokens.c.hash == token.hash_string) \
-                                            .where(self._tokens.c.created == token.created) \
-                                            .where(self._tokens.c.used != None) \
-                                            .values(used = None)
-                res = self._execute(statement)
-                if res.rowcount != 1:
+            if restore_tokens:
+                if self._update_tokens(restore_tokens, self._tokens.c.used != None, None) \
+                        != len(restore_tokens):
                     raise NoValidTokenFoundError("Token could not be validated")
-                self._logger.debug("Token %s validated" % token)
+                self._logger.debug("%d tokens validated", len(restore_tokens))
+
+            if new_tokens:
+                self._execute(self._tokens.insert(),
+                              [{'hash': t.hash_string, 'created': t.created} for t in new_tokens])
+            self._add_to_filter(tokens)
+
+    @timed
+    def mint_tokens(self, tokens):
+        """Insert newly generated tokens with a single statement.
+
+        Unlike create_tokens() this does not look for voided tokens to
+        restore and does not check the token age, so it is only meant
+        for tokens the server just generated itself. They have to be
+        committed within TOKEN_FILTER_MARGIN seconds of their creation,
+        or token filters built in the meantime reject them, see
+        enable_token_filter().
+        """
+        self._logger.debug("mint_tokens(%d tokens)", len(tokens))
+        with self._connection.begin() as trans:
+            self._execute(self._tokens.insert(),
+                          [{'hash': t.hash_string, 'created': t.created} for t in tokens])
+            self._add_to_filter(tokens)
 
     def void_token(self, token):
-        self._logger.debug("void(%s)" % token)
+        self._logger.debug("void(%s)", token)
+        self.void_tokens([token])
+
+    @timed
+    def void_tokens(self, tokens):
+        """Void tokens. Raises NoValidTokenFoundError and voids none of
+        them if any of the tokens is not valid."""
+        self._logger.debug("void_tokens(%d tokens)", len(tokens))
         with self._connection.begin() as trans:
-            statement = self._tokens.update().where(self._tokens.c.hash == token.hash_string) \
-                                            .where(self._tokens.c.created == token.created) \
-                                            .where(self._tokens.c.used == None) \
-                                            .values(used = datetime.utcnow())
-            res = self._execute(statement)
-            if res.rowcount != 1:
+            if len(self._filter_tokens(tokens)) != len(tokens):
+                raise NoValidTokenFoundError("Token could not be voided")
+            if self._update_tokens(tokens, self._tokens.c.used == None, datetime.utcnow()) \
+                    != len(tokens):
                 raise NoValidTokenFoundError("Token could not be voided")
-            self._logger.debug("Token %s voided" % token)
+            self._logger.debug("%d tokens voided", len(tokens))
 
+    @timed
     def validate_token(self, token):
-        self._logger.debug("validate(%s)" % token)
-        result = self._execute(select([self._tokens]) \
+        self._logger.debug("validate(%s)", token)
+        if not self._filter_tokens([token]):
+            self._logger.debug("Token %s not found", token)
+            raise NoValidTokenFoundError("Token not found")
+        statement = select([self._tokens]) \
                             .where(self._tokens.c.hash == token.hash_string) \
                             .where(self._tokens.c.created == token.created) \
-                            .where(self._tokens.c.used == None)).fetchone()
+                            .where(self._tokens.c.used == None)
+        result = self._execute(statement).fetchone()
         if result == None:
-            self._logger.debug("Token %s not found" % token)
+            self._logger.debug("Token %s not found", token)
             raise NoValidTokenFoundError("Token not found")
-        self._logger.debug("Token %s is valid" % token)
+        self._logger.debug("Token %s is valid", token)
+
+    @timed
+    def validate_tokens(self, tokens):
+        """Return the valid tokens out of tokens, keeping their order.
+
+        Tokens are looked up with one query per chunk of tokens instead
+        of one query per token.
+        """
+        self._logger.debug("validate_tokens(%d tokens)", len(tokens))
+        found = set()
+        for chunk in self._chunks(self._filter_tokens(tokens)):
+            # hash is the primary key, so matching created afterwards is
+            # equivalent to a (hash, created) IN (...) query, which not
+            # every backend supports.
+            statement = select([self._tokens.c.hash, self._tokens.c.created]) \
+                            .where(self._tokens.c.hash.in_([token.hash_string for token in chunk])) \
+                            .where(self._tokens.c.used == None)
+            found.update((row.hash, row.created) for row in self._execute(statement))
+        valid_tokens = [token for token in tokens if (token.hash_string, token.created) in found]
+
+        if self._engine is not self._primary_engine and len(valid_tokens) < len(tokens) \
+                and self.config.get('DATABASE_REPLICA_RECHECK_MISSES', True):
+            # Tokens created moments ago may not have reached the replica
+            valid = set(map(id, valid_tokens))
+            with self.session() as primary:
+                primary._engine = self._primary_engine
+                primary.connect()
+                valid.update(map(id, primary.validate_tokens(
+                    [token for token in tokens if id(token) not in valid])))
+            valid_tokens = [token for token in tokens if id(token) in valid]
+        return valid_tokens
+
+    def _chunks(self, tokens, parameters_per_token=1):
+        """Split tokens into chunks using at most DATABASE_CHUNK_SIZE
+        (default 500) bind parameters per statement."""
+        size = self.config.get('DATABASE_CHUNK_SIZE', 500) // parameters_per_token
+        return _chunks(tokens, max(size, 1))
+
+    def _match_tokens(self, tokens, table=None):
+        table = self._tokens if table is None else table
+        return or_(*[and_(table.c.hash == token.hash_string,
+                          table.c.created == token.created) for token in tokens])
+
+    def _find_tokens(self, tokens, condition, table=None):
+        """Return the (hash, created) pairs of tokens matching condition."""
+        table = self._tokens if table is None else table
+        found = set()
+        for chunk in self._chunks(tokens, 2):
+            statement = select([table.c.hash, table.c.created]) \
+                            .where(self._match_tokens(chunk, table)) \
+                            .where(condition)
+            found.update((row.hash, row.created) for row in self._execute(statement))
+        return found
+
+    def _update_tokens(self, tokens, condition, used):
+        """Set used for tokens matching condition. Returns the row count."""
+        rowcount = 0
+        for chunk in self._chunks(tokens, 2):
+            statement = self._tokens.update().where(self._match_tokens(chunk)) \
+                                            .where(condition) \
+                                            .values(used = used)
+            rowcount += self._execute(statement).rowcount
+        return rowcount
 
-    def _execute(self, statement):
-        return self._connection.execute(statement)
+    def _execute(self, statement, *multiparams):
+        return self._connection.execute(statement, *multiparams)
 
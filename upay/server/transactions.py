@@ -0,0 +1,58 @@
+import time
+import random
+import logging
+
+from sqlalchemy.exc import DBAPIError
+
+from . import metrics
+
+# PostgreSQL error codes of transactions aborted by concurrent transactions
+_RETRYABLE_PGCODES = ('40001', '40P01')  # serialization_failure, deadlock_detected
+
+
+class TransactionConflictError(Exception):
+    """A transaction kept conflicting with concurrent transactions."""
+    code = 503
+
+
+def is_retryable(ex):
+    if not isinstance(ex, DBAPIError):
+        return False
+    if getattr(ex.orig, 'pgcode', None) in _RETRYABLE_PGCODES:
+        return True
+    # SQLite reports concurrent writers as a locked database
+    return 'database is locked' in str(ex.orig)
+
+
+def run_in_transaction(token_authority, work, config, name):
+    """Call work(token_authority) and commit.
+
+    If the transaction is aborted because of a serialization failure or
+    a deadlock, it is rolled back and run again after a random delay of
+    up to TRANSACTION_RETRY_DELAY * 2 ** attempt seconds, capped at
+    TRANSACTION_RETRY_MAX_DELAY, up to TRANSACTION_MAX_RETRIES times.
+    Raises TransactionConflictError once the retries are used up.
+    """
+    max_retries = config.get('TRANSACTION_MAX_RETRIES', 5)
+    delay = config.get('TRANSACTION_RETRY_DELAY', 0.01)
+    max_delay = config.get('TRANSACTION_RETRY_MAX_DELAY', 1.0)
+
+    attempt = 0
+    while True:
+        try:
+            result = work(token_authority)
+            token_authority.commit()
+            return result
+        except Exception as ex:
+            if not is_retryable(ex):
+                raise
+            metrics.transaction_conflicts.inc(name)
+            token_authority.rollback()
+            if attempt >= max_retries:
+                metrics.transaction_retries_exhausted.inc(name)
+                logging.getLogger(__name__).warning(
+                    "%s failed after %d retries", name, attempt, exc_info=True)
+                raise TransactionConflictError(str(ex))
+            attempt += 1
+            metrics.transaction_retries.inc(name)
+            time.sleep(random.uniform(0, min(max_delay, delay * 2 ** attempt)))
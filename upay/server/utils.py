@@ -1,8 +1,17 @@
+import math
+import time
+import logging
 import threading
-import logging.config
+from contextlib import contextmanager
 from functools import wraps
 
-from . import app
+from flask import current_app, request, make_response, jsonify
+
+from . import metrics
+from . import admission
+from .sharding import create_token_authority
+from .health import HealthMonitor
+from .group_commit import GroupCommitter
 
 global_lock = threading.RLock()
 
@@ -15,6 +24,251 @@ def get_global_lock(f):
     return decorated
 
 
-def initialize_logging():
-    if 'LOGGING_CONFIG' in app.config:
-        logging.config.fileConfig(app.config['LOGGING_CONFIG'])
\ No newline at end of file
+class StripedLock(object):
+    """A fixed set of locks which keys are hashed onto.
+
+    Locking a set of keys acquires the stripes they map to in ascending
+    order, so two callers locking overlapping sets can not deadlock.
+    """
+
+    def __init__(self, stripes=1024):
+        self._locks = [threading.RLock() for x in xrange(stripes)]
+
+    def _stripes(self, keys):
+        return sorted(set(hash(key) % len(self._locks) for key in keys))
+
+    @contextmanager
+    def locked(self, keys):
+        acquired = []
+        try:
+            for stripe in self._stripes(keys):
+                self._locks[stripe].acquire()
+                acquired.append(stripe)
+            yield
+        finally:
+            for stripe in reversed(acquired):
+                self._locks[stripe].release()
+
+
+_extensions_guard = threading.Lock()
+
+
+def _get_extension(name, factory):
+    """Return the object stored under name for the current app, creating
+    it with factory() on first use. If factory() raises, it is called
+    again next time.
+
+    Looking up an existing object takes no lock. Creating one only locks
+    its name, so a slow factory(), e.g. building the token filter, does
+    not hold up the other extensions.
+    """
+    extensions = current_app.extensions.setdefault('upay', {})
+    if name not in extensions:
+        with _extensions_guard:
+            locks = current_app.extensions.setdefault('upay_locks', {})
+            lock = locks.setdefault(name, threading.Lock())
+        with lock:
+            if name not in extensions:
+                extensions[name] = factory()
+    return extensions[name]
+
+
+def _get_token_locks():
+    config = current_app.config
+    return _get_extension('token_locks',
+        lambda: StripedLock(config.get('LOCK_STRIPES', 1024)))
+
+
+@contextmanager
+def lock_tokens(tokens):
+    """Serialize access to the given tokens.
+
+    With LOCK_MODE = 'global' (the default) this is the process wide
+    global_lock. With LOCK_MODE = 'token' only requests touching the
+    same token hashes are serialized.
+    """
+    if current_app.config.get('LOCK_MODE', 'global') == 'token':
+        lock = _get_token_locks().locked([token.hash_string for token in tokens])
+    else:
+        lock = global_lock
+    start = metrics.clock()
+    with lock:
+        metrics.lock_wait.observe(metrics.clock() - start)
+        yield
+
+
+def instrument(endpoint):
+    """Count and time the requests handled by a view.
+
+    Streamed responses are recorded when they are closed, as their body
+    is produced while it is sent.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            start = metrics.clock()
+
+            def finished(status):
+                metrics.request_duration.observe(metrics.clock() - start, endpoint)
+                metrics.requests.inc(endpoint, status)
+
+            try:
+                response = f(*args, **kwargs)
+            except Exception as ex:
+                metrics.errors.inc(endpoint, type(ex).__name__)
+                finished(getattr(ex, 'code', 500))
+                raise
+            if response.is_streamed:
+                response.call_on_close(lambda: finished(response.status_code))
+            else:
+                finished(response.status_code)
+            return response
+        return decorated
+    return decorator
+
+
+def _get_rate_limiter():
+    config = current_app.config
+    return _get_extension('rate_limiter',
+        lambda: admission.RateLimiter(config['RATE_LIMIT'], config.get('RATE_LIMIT_BURST'),
+                                      config.get('RATE_LIMIT_MAX_CLIENTS', 10000)))
+
+
+def _get_admission_queue():
+    config = current_app.config
+    return _get_extension('admission_queue',
+        lambda: admission.AdmissionQueue(config['ADMISSION_MAX_ACTIVE'],
+                                         config.get('ADMISSION_MAX_WAITING'),
+                                         config.get('ADMISSION_TIMEOUT', 1.0)))
+
+
+def _client_identity():
+    header = current_app.config.get('RATE_LIMIT_HEADER')
+    if header is not None and header in request.headers:
+        return request.headers[header]
+    return request.remote_addr
+
+
+def _reject(endpoint, reason, status, retry_after):
+    admission.rejected.inc(endpoint, reason)
+    response = make_response(jsonify({'error': 'Too many requests'}), status)
+    response.headers['Retry-After'] = str(int(math.ceil(retry_after)))
+    return response
+
+
+def admit(endpoint):
+    """Apply the rate limit of the client and admission control to a
+    view.
+
+    With RATE_LIMIT set, each client (by the RATE_LIMIT_HEADER header or
+    the remote address) may send that many requests per second, with
+    bursts of RATE_LIMIT_BURST; excess requests get status 429. With
+    ADMISSION_MAX_ACTIVE set, requests beyond that many at once wait in
+    a queue of ADMISSION_MAX_WAITING for at most ADMISSION_TIMEOUT
+    seconds, or get status 503. Both answer with a Retry-After header.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            config = current_app.config
+            if config.get('RATE_LIMIT'):
+                wait = _get_rate_limiter().acquire(_client_identity())
+                if wait > 0:
+                    return _reject(endpoint, 'rate_limited', 429, wait)
+
+            if not config.get('ADMISSION_MAX_ACTIVE'):
+                return f(*args, **kwargs)
+
+            queue = _get_admission_queue()
+            if not queue.acquire():
+                return _reject(endpoint, 'overloaded', 503, queue.timeout)
+            try:
+                response = f(*args, **kwargs)
+            except Exception:
+                queue.release()
+                raise
+            if response.is_streamed:
+                # The work happens while the response is sent
+                response.call_on_close(queue.release)
+            else:
+                queue.release()
+            return response
+        return decorated
+    return decorator
+
+
+def _create_token_authority(config):
+    token_authority = create_token_authority(config)
+    if config.get('TOKEN_FILTER_CAPACITY'):
+        token_authority.enable_token_filter(config['TOKEN_FILTER_CAPACITY'],
+                                            config.get('TOKEN_FILTER_ERROR_RATE', 0.001),
+                                            config.get('TOKEN_FILTER_MARGIN', 600))
+    if config.get('COMPACTION_INTERVAL'):
+        start_compaction(token_authority, config)
+    return token_authority
+
+
+def get_token_authority():
+    """Return the TokenAuthority of the current app.
+
+    It is created on first use. If the database can not be reached the
+    RuntimeError is passed on and creation is retried on the next call.
+    """
+    config = current_app.config
+    return _get_extension('token_authority', lambda: _create_token_authority(config))
+
+
+def get_group_committer():
+    """Return the GroupCommitter of the current app, or None unless
+    GROUP_COMMIT is set."""
+    config = current_app.config
+    if not config.get('GROUP_COMMIT'):
+        return None
+    token_authority = get_token_authority()
+    return _get_extension('group_committer',
+        lambda: GroupCommitter(token_authority, config))
+
+
+def get_health_monitor():
+    """Return the HealthMonitor of the current app, which checks the
+    database every HEALTH_CHECK_INTERVAL (default 5) seconds."""
+    app = current_app._get_current_object()
+
+    def probe():
+        with app.app_context():
+            token_authority = get_token_authority()
+            token_authority.check_health()
+
+    config = current_app.config
+    return _get_extension('health_monitor',
+        lambda: HealthMonitor(probe, config.get('HEALTH_CHECK_INTERVAL', 5),
+                              config.get('HEALTH_CHECK_MAX_AGE')))
+
+
+def token_filter_stats():
+    """Return the token filter statistics of the current app's
+    TokenAuthority, or None if there is none yet."""
+    token_authority = current_app.extensions.get('upay', {}).get('token_authority')
+    if token_authority is None:
+        return None
+    return token_authority.token_filter_stats()
+
+
+def start_compaction(token_authority, config):
+    """Archive voided tokens every COMPACTION_INTERVAL seconds in a
+    daemon thread."""
+    logger = logging.getLogger(__name__)
+
+    def compact():
+        while True:
+            time.sleep(config['COMPACTION_INTERVAL'])
+            try:
+                token_authority.compact(config.get('ARCHIVE_RETENTION', 30 * 24 * 3600),
+                                        config.get('COMPACTION_BATCH_SIZE', 1000))
+            except Exception:
+                logger.warning("Compaction failed", exc_info=True)
+
+    thread = threading.Thread(target=compact, name='compaction')
+    thread.daemon = True
+    thread.start()
+    return thread
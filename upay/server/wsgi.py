@@ -0,0 +1,4 @@
+# WSGI entry point, e.g. `gunicorn --preload upay.server.wsgi:app`
+from . import create_app
+
+app = create_app()